@@ -0,0 +1,529 @@
+# -*- coding: utf-8 -*-
+# pylint: disable=locally-disabled, bad-continuation
+""" Benchmark the "webdav" upload path against a local Artifactory stand-in server.
+
+    The server runs in a child process, and emulates what "webdav.py" talks to:
+    PUT with matrix params and `X-Checksum-*` headers (including checksum deploys
+    and exploded archives), GET / HEAD / PROPFIND of collections and files.
+    Latency, bandwidth, TLS, and an error rate can be configured, errors being
+    injected from a seeded random generator, so that results are comparable
+    from run to run.
+
+    Call "python benchmark.py --help" for options; results are reported as JSON.
+    The unit tests of "webdav.py" run the same server in a thread.
+"""
+from __future__ import with_statement, print_function
+
+import io
+import os
+import ssl
+import sys
+import json
+import time
+import random
+import shutil
+import socket
+import hashlib
+import tarfile
+import resource
+import tempfile
+import optparse
+import threading
+import traceback
+import subprocess
+import ConfigParser
+import BaseHTTPServer
+import SocketServer
+import urllib2
+import multiprocessing
+from contextlib import closing
+from cStringIO import StringIO
+
+import webdav
+
+
+# Block size for reading request bodies
+CHUNK_SIZE = 64 * 1024
+
+# Path prefix of the server's control endpoints
+CONTROL_PATH = "/_bench/"
+
+# Incoming template used for uploads
+INCOMING = "%(scheme)s://127.0.0.1:%(port)d/artifactory/debian-local/{source}/{upstream}/;deb.distribution={distribution}"
+
+
+#
+# Stand-in server
+#
+
+class StandInHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Request handler emulating Artifactory's WebDAV and deploy endpoints."""
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args): # pylint: disable=arguments-differ
+        """Keep quiet."""
+
+    def setup(self):
+        """Count connections."""
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        self.server.count("connections")
+
+    def reply(self, status, body="", headers=(), length=None):
+        """Send a complete response."""
+        self.send_response(status)
+        for name, value in headers:
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body) if length is None else length))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    def path_and_params(self):
+        """Return the request path without matrix params, and those params."""
+        path = urllib2.unquote(self.path.split('?')[0])
+        path, _, params = path.partition(';')
+        return path, params
+
+    def begin(self):
+        """Common request processing; returns False for handled control requests."""
+        if self.path.startswith(CONTROL_PATH):
+            self.server.count("control")
+            if self.command == "GET":
+                self.reply(200, json.dumps(self.server.snapshot()), [("Content-Type", "application/json")])
+            else:
+                self.server.reset()
+                self.reply(204)
+            return False
+
+        self.server.count("requests", (self.command, self.path))
+        if self.server.opts.latency:
+            time.sleep(self.server.opts.latency)
+        return True
+
+    def read_body(self, digests=(), sink=None):
+        """Read the request body at the configured bandwidth, feeding it to `digests`, and writing it to `sink`."""
+        remaining = int(self.headers.get("Content-Length", "0"), 10)
+        bandwidth = self.server.opts.bandwidth * 1024 * 1024
+        started = time.time()
+        received = 0
+        while remaining:
+            data = self.rfile.read(min(CHUNK_SIZE, remaining))
+            if not data:
+                break
+            remaining -= len(data)
+            received += len(data)
+            for digest in digests:
+                digest.update(data)
+            if sink:
+                sink.write(data)
+            if bandwidth:
+                delay = started + received / bandwidth - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+        return received
+
+    def do_GET(self):
+        """Return stored files, and collections."""
+        if not self.begin():
+            return
+        path, _ = self.path_and_params()
+        meta = self.server.files.get(path)
+        partial = self.server.partial.get(path)
+        if meta:
+            self.reply(200, '\0' * meta["size"], length=meta["size"], headers=[
+                ("X-Checksum-" + algo.capitalize(), meta[algo]) for algo in webdav.CHECKSUM_ALGOS])
+        elif partial is not None and self.headers.get("Range"):
+            start, end = [int(i, 10) for i in self.headers["Range"].split('=', 1)[1].split('-')]
+            end = min(end, len(partial) - 1)
+            self.reply(206, partial[start:end + 1], [("Content-Range", "bytes %d-%d/%d" % (start, end, len(partial)))])
+        elif partial is not None:
+            self.reply(200, partial)
+        elif path.endswith('/'):
+            self.reply(200, "<html><body>%s</body></html>" % path, [("Content-Type", "text/html")])
+        else:
+            self.reply(404, "Not Found")
+
+    do_HEAD = do_GET
+
+    def do_DELETE(self):
+        """Only supported for resetting the server."""
+        if self.begin():
+            self.reply(405, "Method Not Allowed")
+
+    def do_PROPFIND(self):
+        """List a collection, Depth 1."""
+        if not self.begin():
+            return
+        self.read_body()
+        path = self.path_and_params()[0].rstrip('/') + '/'
+        members = sorted((name, meta) for name, meta in self.server.files.items()
+            if name.startswith(path) and '/' not in name[len(path):])
+
+        body = ['<?xml version="1.0" encoding="UTF-8"?>\n<D:multistatus xmlns:D="DAV:">'
+            '<D:response><D:href>%s</D:href><D:propstat><D:prop><D:resourcetype><D:collection/></D:resourcetype>'
+            '</D:prop><D:status>HTTP/1.1 200 OK</D:status></D:propstat></D:response>' % path]
+        for name, meta in members:
+            body.append('<D:response><D:href>%s</D:href><D:propstat><D:prop><D:resourcetype/>'
+                '<D:getcontentlength>%d</D:getcontentlength><D:getetag>"%s"</D:getetag></D:prop>'
+                '<D:status>HTTP/1.1 200 OK</D:status></D:propstat></D:response>' % (name, meta["size"], meta["sha1"]))
+        body.append('</D:multistatus>')
+        self.reply(207, "".join(body), [("Content-Type", "application/xml; charset=UTF-8")])
+
+    def do_PUT(self):
+        """Deploy a file, by content or by checksum."""
+        if not self.begin():
+            return
+        started = time.time()
+        path, _ = self.path_and_params()
+
+        if self.headers.get("X-Checksum-Deploy", "").lower() == "true":
+            self.read_body()
+            sha1 = self.headers.get("X-Checksum-Sha1", "")
+            known = [i for i in self.server.files.values() if i["sha1"] == sha1]
+            if not known:
+                return self.reply(404, "Checksum deploy failed: no content with SHA1 %s" % sha1)
+            self.server.store(path, dict(known[0]), 0, time.time() - started)
+            return self.reply(201, "Created")
+
+        if self.headers.get("X-Explode-Archive", "").lower() == "true":
+            return self.explode(path, started)
+
+        content_range = None if self.server.ignore_ranges else self.headers.get("Content-Range")
+        if content_range and self.server.range_status:
+            self.read_body()
+            return self.reply(self.server.range_status, "Partial PUT not supported")
+
+        fault = self.server.next_fault()
+        body = StringIO() if content_range or fault else None
+        digests = [getattr(hashlib, algo)() for algo in webdav.CHECKSUM_ALGOS]
+        size = self.read_body(digests, sink=body)
+        data = body and body.getvalue()
+        if content_range:
+            start = int(content_range.split()[1].split('-')[0], 10)
+            if start != len(self.server.partial.get(path, "")):
+                return self.reply(416, "Range does not continue the stored data")
+            data = self.server.partial[path] + data
+        if fault:
+            status, kept = fault
+            self.server.partial[path] = data[:kept]
+            return self.reply(status, "Failed (injected)", [("Retry-After", "0")])
+        if self.server.inject_error():
+            return self.reply(503, "Service Unavailable (injected)", [("Retry-After", "0")])
+
+        meta = dict(zip(webdav.CHECKSUM_ALGOS, [i.hexdigest() for i in digests]), size=size)
+        if content_range:
+            meta = dict((algo, getattr(hashlib, algo)(data).hexdigest()) for algo in webdav.CHECKSUM_ALGOS)
+            meta["size"] = len(data)
+        for algo in webdav.CHECKSUM_ALGOS if self.server.verify_checksums else ():
+            expected = self.headers.get("X-Checksum-" + algo.capitalize())
+            if expected and expected != meta[algo]:
+                return self.reply(409, "Checksum mismatch for %s" % algo)
+        self.server.store(path, meta, size, time.time() - started)
+        self.reply(201, "Created")
+
+    def explode(self, path, started):
+        """Deploy the members of the tar archive in the request body next to `path`."""
+        body = StringIO()
+        self.read_body(sink=body)
+        body.seek(0)
+        try:
+            archive = tarfile.open(fileobj=body)
+            members = [(i.name, archive.extractfile(i).read()) for i in archive.getmembers() if i.isfile()]
+        except tarfile.TarError, exc:
+            return self.reply(400, "Cannot explode archive: %s" % exc)
+        for name, data in members:
+            meta = dict((algo, getattr(hashlib, algo)(data).hexdigest()) for algo in webdav.CHECKSUM_ALGOS)
+            meta["size"] = len(data)
+            self.server.store(path.rsplit('/', 1)[0] + '/' + name, meta, len(data), time.time() - started)
+        self.reply(200, "Exploded %d file(s)" % len(members))
+
+
+class StandInServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Threaded stand-in server, with counters and stored file metadata."""
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, opts):
+        BaseHTTPServer.HTTPServer.__init__(self, ("127.0.0.1", opts.port), StandInHandler)
+        self.opts = opts
+        self.lock = threading.Lock()
+        self.files = {}
+        self.stats = {}
+        self.history = []
+        self.partial = {}  # path -> data of an interrupted upload, continued by a `Content-Range` PUT
+        self.faults = []  # scripted (status, kept bytes) replies to the next PUTs, for tests
+        self.range_status = None  # status rejecting `Content-Range` PUTs with, if not supported
+        self.ignore_ranges = False  # store the body of a `Content-Range` PUT as the whole file
+        self.verify_checksums = True  # reject content not matching its `X-Checksum-*` headers
+        self.random = None
+        self.reset()
+        if opts.tls:
+            self.socket = ssl.wrap_socket(self.socket, certfile=opts.certfile, server_side=True)
+
+    def handle_error(self, request, client_address):
+        """Ignore clients closing their connection, report other errors on stderr."""
+        if not isinstance(sys.exc_info()[1], socket.error):
+            traceback.print_exc(file=sys.stderr)
+
+    def reset(self):
+        """Forget all files, and zero all counters."""
+        with self.lock:
+            self.files.clear()
+            self.partial.clear()
+            del self.history[:]
+            del self.faults[:]
+            self.stats = dict(connections=0, control=0, requests=0, puts=0, errors=0, bytes=0, latencies={})
+            self.random = random.Random(self.opts.seed)
+
+    def count(self, name, request=None):
+        """Increment counter `name`, and record the (method, path) of a `request`."""
+        with self.lock:
+            self.stats[name] += 1
+            if request:
+                self.history.append(request)
+
+    def inject_error(self):
+        """Decide whether to fail the current PUT."""
+        with self.lock:
+            failed = self.random.random() < self.opts.error_rate
+            self.stats["errors"] += failed
+            return failed
+
+    def next_fault(self):
+        """Return the next scripted fault, or None."""
+        with self.lock:
+            return self.faults.pop(0) if self.faults else None
+
+    def store(self, path, meta, size, duration):
+        """Record a deployed file, and the time it took."""
+        with self.lock:
+            self.files[path] = meta
+            self.partial.pop(path, None)
+            self.stats["puts"] += 1
+            self.stats["bytes"] += size
+            self.stats["latencies"][path] = self.stats["latencies"].get(path, 0) + duration
+
+    def snapshot(self):
+        """Return the counters, excluding control connections."""
+        with self.lock:
+            result = dict(self.stats)
+            result["connections"] -= result.pop("control")
+            return result
+
+
+def serve(opts, ready):
+    """Run the stand-in server until killed, putting its port into `ready`."""
+    server = StandInServer(opts)
+    ready.put(server.server_address[1])
+    server.serve_forever()
+
+
+def _self_signed_cert(tmpdir):
+    """Create a self-signed certificate for TLS tests via 'openssl', return the combined PEM file."""
+    pem = os.path.join(tmpdir, "server.pem")
+    subprocess.check_call(["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1",
+        "-subj", "/CN=127.0.0.1", "-keyout", pem, "-out", pem + ".crt"],
+        stdout=open(os.devnull, 'w'), stderr=subprocess.STDOUT)
+    with closing(io.open(pem, 'ab')) as handle:
+        with closing(io.open(pem + ".crt", 'rb')) as crt:
+            handle.write(crt.read())
+    return pem
+
+
+#
+# Client side
+#
+
+def make_changes_set(tmpdir, count, size, seed):
+    """Create `count` files of `size` bytes with reproducible contents, plus a changes file listing them."""
+    files = []
+    for idx in range(count):
+        filepath = os.path.join(tmpdir, "bench_1.0-%d_all.deb" % idx)
+        block = "".join(hashlib.sha512("%d:%d:%d" % (seed, idx, i)).digest()
+            for i in range(min(size, 1024 * 1024) // 64 + 1))
+        with closing(io.open(filepath, 'wb')) as handle:
+            remaining = size
+            while remaining:
+                handle.write(block[:remaining])
+                remaining -= min(remaining, len(block))
+        files.append(filepath)
+
+    sums = [(webdav._file_checksums(i), os.path.getsize(i), os.path.basename(i)) for i in files] # pylint: disable=protected-access
+    changes = os.path.join(tmpdir, "bench_1.0_all.changes")
+    with closing(io.open(changes, 'wb')) as handle:
+        handle.write("Format: 1.8\nSource: bench\nBinary: bench\nArchitecture: all\n"
+            "Version: 1.0\nDistribution: unstable\nUrgency: low\n")
+        for field, algo in (("Checksums-Sha1", "sha1"), ("Checksums-Sha256", "sha256"), ("Files", "md5")):
+            handle.write(field + ":\n")
+            for checksums, filesize, name in sums:
+                handle.write(" %s %d%s %s\n" % (checksums[algo], filesize,
+                    " misc optional" if field == "Files" else "", name))
+    return files + [changes]
+
+
+def percentiles(values, points=(50, 90, 99)):
+    """Return nearest-rank percentiles of `values`, plus the maximum."""
+    values = sorted(values)
+    if not values:
+        return {}
+    result = dict(("p%d" % i, values[max(0, -(-len(values) * i // 100) - 1)]) for i in points)
+    result["max"] = values[-1]
+    return result
+
+
+def run_upload(opts, url, files):
+    """ Upload the changes set via `upload()`; latencies are measured by the server.
+
+        Returns False if the upload failed (`upload()` exits in that case).
+    """
+    config = ConfigParser.ConfigParser()
+    config.add_section("bench")
+    config.set("bench", "method", "webdav")
+    for key, val in opts.options:
+        config.set("bench", key, val)
+    webdav.upload.extended_info = dict(config=config, host="bench")
+    try:
+        webdav.upload("127.0.0.1", "bench:bench", url + "#overwrite=1", files, opts.debug, False, progress=0)
+    except SystemExit:
+        return False
+    return True
+
+
+def run_dav_put(opts, url, files):
+    """Upload each file via `_dav_put()`, one after the other, returning per-file latencies."""
+    incoming, matrix_params, _ = webdav._resolve_incoming("127.0.0.1", "bench:bench", url, # pylint: disable=protected-access
+        changes=files[-1], repo_mappings="")
+    options = dict(opts.options)
+    retry = webdav.RetryPolicy(retries=int(options.get("retries", "3"), 10), delay=0)
+    known = webdav._changes_checksums(webdav._parse_changes(files[-1])) # pylint: disable=protected-access
+    pool = webdav.ConnectionPool()
+    latencies = []
+    try:
+        for filepath in files:
+            started = time.time()
+            webdav._dav_put(filepath, incoming, matrix_params, "bench:bench", progress=0, # pylint: disable=protected-access
+                checksums=known.get(os.path.basename(filepath)), pool=pool, retry=retry,
+                checksum_deploy=options.get("checksum_deploy", "0").lower() in ("1", "true", "yes", "on"))
+            latencies.append(time.time() - started)
+    finally:
+        pool.close()
+    return latencies
+
+
+def control(base_url, method="GET"):
+    """Call the server's control endpoint."""
+    request = urllib2.Request(base_url + CONTROL_PATH + "stats")
+    request.get_method = lambda: method
+    with closing(urllib2.urlopen(request)) as handle:
+        return json.loads(handle.read() or "null")
+
+
+def benchmark(opts):
+    """Run the configured benchmark, and return its report."""
+    tmpdir = tempfile.mkdtemp(prefix="webdav-bench-")
+    server = None
+    try:
+        if opts.tls and not opts.certfile:
+            opts.certfile = _self_signed_cert(tmpdir)
+        ready = multiprocessing.Queue()
+        server = multiprocessing.Process(target=serve, args=(opts, ready))
+        server.daemon = True
+        server.start()
+        port = ready.get(timeout=10)
+
+        scheme = "https" if opts.tls else "http"
+        base_url = "%s://127.0.0.1:%d" % (scheme, port)
+        url = INCOMING % dict(scheme=scheme, port=port)
+        if opts.tls and hasattr(ssl, "_create_unverified_context"):
+            ssl._create_default_https_context = ssl._create_unverified_context # pylint: disable=protected-access
+
+        files = make_changes_set(tmpdir, opts.files, opts.size * 1024, opts.seed)
+        total = sum(os.path.getsize(i) for i in files)
+
+        runs = []
+        for _ in range(opts.runs):
+            control(base_url, "DELETE")
+            stdout, sys.stdout = sys.stdout, sys.stderr  # keep progress output out of the report
+            try:
+                started = time.time()
+                if opts.mode == "upload":
+                    failed = not run_upload(opts, url, files)
+                    client_latencies = None
+                else:
+                    client_latencies = run_dav_put(opts, url, files)
+                    failed = False
+                elapsed = time.time() - started
+            finally:
+                sys.stdout = stdout
+            stats = control(base_url)
+
+            latencies = client_latencies or stats["latencies"].values()
+            runs.append(dict(
+                elapsed=round(elapsed, 4),
+                throughput_mib_s=round(total / elapsed / 1024 / 1024, 3),
+                latency_ms=dict((k, round(v * 1000, 2)) for k, v in percentiles(latencies).items()),
+                connections=stats["connections"],
+                requests=stats["requests"],
+                transferred=stats["bytes"],
+                injected_errors=stats["errors"],
+                failed=failed,
+            ))
+
+        median = sorted(runs, key=lambda i: i["elapsed"])[len(runs) // 2]
+        return dict(
+            config=dict(mode=opts.mode, files=opts.files, size_kib=opts.size, runs=opts.runs, seed=opts.seed,
+                latency=opts.latency, bandwidth_mib_s=opts.bandwidth, error_rate=opts.error_rate, tls=opts.tls,
+                options=dict(opts.options)),
+            bytes=total,
+            median=median,
+            runs=runs,
+            peak_rss_kib=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,  # over all runs
+        )
+    finally:
+        if server and server.is_alive():
+            server.terminate()
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+def main(argv=None):
+    """Command line interface."""
+    parser = optparse.OptionParser(usage="%prog [options]")
+    parser.add_option("-m", "--mode", choices=("upload", "dav_put"), default="upload",
+        help="drive 'upload' (a whole changes set) or '_dav_put' (file by file) [%default]")
+    parser.add_option("-n", "--files", type="int", default=10, help="number of files per changes set [%default]")
+    parser.add_option("-s", "--size", type="int", default=1024, help="size of each file in KiB [%default]")
+    parser.add_option("-r", "--runs", type="int", default=3, help="number of measured runs [%default]")
+    parser.add_option("-o", "--option", dest="options", action="append", default=[], metavar="KEY=VAL",
+        help="webdav host option, e.g. 'workers=4' or 'checksum_deploy=1' (repeatable)")
+    parser.add_option("--latency", type="float", default=0.0, help="server delay per request in seconds")
+    parser.add_option("--bandwidth", type="float", default=0.0, help="upload bandwidth limit per connection in MiB/s")
+    parser.add_option("--error-rate", type="float", default=0.0, help="fraction of PUTs failed with HTTP 503")
+    parser.add_option("--tls", action="store_true", default=False, help="serve HTTPS")
+    parser.add_option("--certfile", help="PEM file with certificate and key (default: a self-signed one)")
+    parser.add_option("--port", type="int", default=0, help="server port (default: any free one)")
+    parser.add_option("--seed", type="int", default=42, help="seed for file contents and injected errors")
+    parser.add_option("--output", help="write the JSON report to this file")
+    parser.add_option("-d", "--debug", action="store_true", default=False, help="show webdav debug traces")
+    opts, args = parser.parse_args(argv)
+    if args:
+        parser.error("Unexpected arguments: %s" % " ".join(args))
+    try:
+        opts.options = [tuple(i.split('=', 1)) for i in opts.options]
+        if any(len(i) != 2 for i in opts.options):
+            raise ValueError("expected KEY=VAL")
+    except ValueError, exc:
+        parser.error("Bad --option: %s" % exc)
+
+    report = json.dumps(benchmark(opts), indent=4, sort_keys=True)
+    if opts.output:
+        with closing(io.open(opts.output, 'wb')) as handle:
+            handle.write(report + "\n")
+    else:
+        print(report)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
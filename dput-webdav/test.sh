@@ -33,6 +33,7 @@ ln -nfs "../../webdav.py" build/plugins
 echo
 echo "*** Python unit tests **"
 python -m webdav
+python ../indexing/debindex.py test
 
 if test $(ls -1 build/artifactory-debian-webdav-test*.changes | wc -l) -ne 1; then
     echo
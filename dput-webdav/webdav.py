@@ -6,22 +6,27 @@
 """
 from __future__ import with_statement, print_function
 
+# Only modules needed for every upload (and the tests' base class) are imported here, others when used
+
 import io
 import re
 import os
 import sys
-import cgi
-import netrc
+import mmap
+import time
+import random
+import select
 import socket
 import fnmatch
-import getpass
 import hashlib
 import httplib
 import urllib2
 import urlparse
 import unittest
-from contextlib import closing
+import threading
+from contextlib import closing, contextmanager
 from email import parser as rfc2822_parser
+from email import utils as rfc2822_utils
 
 try:
     import dputhelper
@@ -30,8 +35,36 @@ except ImportError:
     import dputhelper
 
 
-# Block size for upload streaming
+# Block size for upload streaming; over TLS it grows with the measured throughput
 CHUNK_SIZE = 16 * 1024
+MAX_CHUNK_SIZE = 4 * 1024 * 1024
+CHUNK_SECONDS = 0.05  # targeted duration of sending one block
+
+# Amount passed to a single `sendfile` call, i.e. the granularity of progress updates
+SENDFILE_BLOCK = 4 * 1024 * 1024
+
+# Block size for hashing file contents
+HASH_BLOCK_SIZE = 1024 * 1024
+
+# Digest algorithms sent as "X-Checksum-*" headers, and their field in a changes file
+CHECKSUM_ALGOS = ("md5", "sha1", "sha256")
+CHANGES_CHECKSUM_FIELDS = dict(md5="files", sha1="checksums_sha1", sha256="checksums_sha256")
+
+# Artifactory properties that place a package in its Debian repository indexes
+DEB_PROPERTIES = ("deb.distribution", "deb.component", "deb.architecture")
+
+# HTTP status codes of transient server conditions, worth a retry
+RETRY_STATUS = (408, 429, 500, 502, 503, 504)
+
+# Properties requested for collection listings
+PROPFIND_BODY = ('<?xml version="1.0" encoding="utf-8"?>\n<D:propfind xmlns:D="DAV:"><D:prop>'
+    '<D:resourcetype/><D:getcontentlength/><D:getetag/></D:prop></D:propfind>\n')
+
+# Size of the already uploaded tail that is compared before resuming an upload
+RESUME_VERIFY_SIZE = 64 * 1024
+
+# Extension of the upload journal, kept next to the changes file of an incomplete upload
+JOURNAL_SUFFIX = ".webdav-journal"
 
 
 def trace(msg, **kwargs):
@@ -48,6 +81,97 @@ def log(msg, **kwargs):
     sys.stderr.flush()
 
 
+class Timings(object):
+    """ Record of timed upload phases, shared by all threads of an upload.
+
+        The result goes to a JSON report file, or to a statsd server.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.events = []
+
+    def add(self, phase, seconds, size=None, **tags):
+        """Record that `phase` took `seconds`, processing `size` bytes."""
+        event = dict(tags, phase=phase, seconds=round(seconds, 6))
+        if size is not None:
+            event["bytes"] = size
+            event["mb_per_sec"] = round(size / seconds / 1E6, 3) if seconds > 0 else None
+        with self.lock:
+            self.events.append(event)
+
+    def summary(self):
+        """Return totals per phase."""
+        result = {}
+        with self.lock:
+            for event in self.events:
+                phase = result.setdefault(event["phase"], dict(count=0, seconds=0.0))
+                phase["count"] += 1
+                phase["seconds"] += event["seconds"]
+                if "bytes" in event:
+                    phase["bytes"] = phase.get("bytes", 0) + event["bytes"]
+        for phase in result.values():
+            phase["seconds"] = round(phase["seconds"], 6)
+            if phase.get("bytes") is not None and phase["seconds"] > 0:
+                phase["mb_per_sec"] = round(phase["bytes"] / phase["seconds"] / 1E6, 3)
+        return result
+
+    def write_report(self, filename):
+        """Write all phases and events as JSON to `filename`."""
+        import json
+
+        with self.lock:
+            events = list(self.events)
+        report = dict(started=rfc2822_utils.formatdate(self.started, usegmt=True),
+            elapsed=round(time.time() - self.started, 6), phases=self.summary(), events=events)
+        with closing(io.open(filename, 'wb')) as handle:
+            handle.write(json.dumps(report, indent=4, sort_keys=True) + "\n")
+
+    def send_statsd(self, address, prefix):
+        """Send phase timers and byte counters to the statsd server at `address` ("host:port")."""
+        host, port = (address.rsplit(':', 1) + ["8125"])[:2]
+        lines = []
+        for name, phase in sorted(self.summary().items()):
+            lines.append("%s.%s:%d|ms" % (prefix, name, phase["seconds"] * 1000))
+            if "bytes" in phase:
+                lines.append("%s.%s.bytes:%d|c" % (prefix, name, phase["bytes"]))
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            for line in lines:
+                sock.sendto(line, (host, int(port, 10)))
+        finally:
+            sock.close()
+
+
+@contextmanager
+def timed(phase, **tags):
+    """ Time the enclosed block as `phase` of an upload, if timings are recorded.
+
+        Set "bytes" in the yielded dict to record the amount of data processed.
+    """
+    info = {}
+    started = time.time()
+    try:
+        yield info
+    except: # pylint: disable=bare-except
+        tags["failed"] = True
+        raise
+    finally:
+        if timed.recorder:
+            timed.recorder.add(phase, time.time() - started, info.get("bytes"), **tags)
+timed.recorder = None
+
+
+def _parse_qsl(query):
+    """Parse a query string into a list of key / value pairs, keeping blank values."""
+    try:
+        parse_qsl = urlparse.parse_qsl
+    except AttributeError: # Python 2.5
+        from cgi import parse_qsl
+    return parse_qsl(query, keep_blank_values=True)
+
+
 def _resolve_credentials(fqdn, login):
     """Look up special forms of credential references."""
     result = login
@@ -55,6 +179,8 @@ def _resolve_credentials(fqdn, login):
         result = os.path.expandvars(result)
 
     if result.startswith("netrc:"):
+        import netrc
+
         result = result.split(':', 1)[1]
         if result:
             result = os.path.abspath(os.path.expanduser(result))
@@ -102,6 +228,7 @@ class PromptingPasswordMgr(urllib2.HTTPPasswordMgr):
             if ':' in credentials:
                 authinfo = credentials.split(':', 1)
             else:
+                import getpass
                 password = getpass.getpass("    Password for %s:" % realm)
                 self.add_password(realm, authuri, credentials, password)
                 authinfo = credentials, password
@@ -109,15 +236,25 @@ class PromptingPasswordMgr(urllib2.HTTPPasswordMgr):
         return authinfo
 
 
+def _compile_repo_mappings(repo_mappings):
+    """Parse the `repo_mappings` config value into a list of compiled patterns and their target repos."""
+    try:
+        return _compile_repo_mappings.cache[repo_mappings]
+    except KeyError:
+        mappings = [(i.split('=', 1) if '=' in i else (i, i)) for i in repo_mappings.split()]
+        result = _compile_repo_mappings.cache[repo_mappings] = [
+            (re.compile(fnmatch.translate(pattern.lower())), target) for pattern, target in mappings
+        ]
+        return result
+_compile_repo_mappings.cache = {}
+
+
 def _distro2repo(distro, repo_mappings):
     """Map distribution names to repo names according to config settings."""
-    # Parse the mapping config
-    mappings = [(i.split('=', 1) if '=' in i else (i, i)) for i in repo_mappings.split()]
-
     # Try to find a match
     result = distro
-    for pattern, target in mappings:
-        if fnmatch.fnmatchcase(distro.lower(), pattern.lower()):
+    for pattern, target in _compile_repo_mappings(repo_mappings):
+        if pattern.match(distro.lower()):
             result = target
             break
 
@@ -125,20 +262,9 @@ def _distro2repo(distro, repo_mappings):
     return result
 
 
-def _resolve_incoming(fqdn, login, incoming, changes=None, cli_params=None, repo_mappings=""):
-    """Resolve the given `incoming` value to a working URL."""
-    # Build fully qualified URL
-    scheme, netloc, path, matrix_params, query, anchor = urlparse.urlparse(incoming, scheme="http", allow_fragments=True)
-    if scheme not in ("http", "https"):
-        raise dputhelper.DputUploadFatalException("Unsupported URL scheme '%s'" % scheme)
-    url = urlparse.urlunparse((scheme, netloc or fqdn, path.rstrip('/') + '/', '', query, None))
-
-    # Parse anchor to parameters
-    url_params = dict(cgi.parse_qsl(anchor or '', keep_blank_values=True))
-
-    # Read changes from stream or file
-    pkgdata = {}
-    if changes:
+def _parse_changes(changes):
+    """Parse a change record given as a stream, file name, or string, into a dict of its fields."""
+    with timed("changes") as info:
         try:
             changes + ""
         except TypeError:
@@ -151,6 +277,7 @@ def _resolve_incoming(fqdn, login, incoming, changes=None, cli_params=None, repo
             if '\n' not in changes:
                 with closing(io.open(changes, 'r', encoding='utf-8')) as handle:
                     changes = handle.read()
+        info["bytes"] = len(changes)
 
         if changes.startswith("-----BEGIN PGP SIGNED MESSAGE-----"):
             # Let someone else check this, we don't care a bit; gimme the data already
@@ -160,9 +287,104 @@ def _resolve_incoming(fqdn, login, incoming, changes=None, cli_params=None, repo
         pkgdata = dict([(key.lower().replace('-', '_'), val.strip())
             for key, val in rfc2822_parser.HeaderParser().parsestr(changes).items()
         ])
-        if 'architecture' in pkgdata:
-            # This is a bit hackish, but Artiactory wants it that way
-            pkgdata['deb_architecture'] = ';deb.architecture='.join(pkgdata['architecture'].split())
+    if 'architecture' in pkgdata:
+        # This is a bit hackish, but Artiactory wants it that way
+        pkgdata['deb_architecture'] = ';deb.architecture='.join(pkgdata['architecture'].split())
+
+    return pkgdata
+
+
+def _changes_checksums(pkgdata):
+    """ Return a mapping of file names to their size and digests,
+        as listed in the "Files" and "Checksums-*" fields of parsed changes.
+    """
+    result = {}
+    for algo, field in CHANGES_CHECKSUM_FIELDS.items():
+        for line in pkgdata.get(field, "").splitlines():
+            words = line.split()
+            if len(words) < 3:
+                continue
+            # "Files" lines are "md5 size section priority name", others "digest size name"
+            entry = result.setdefault(words[-1], {})
+            try:
+                size = int(words[1], 10)
+            except ValueError:
+                continue
+            if entry.setdefault("size", size) == size:
+                entry[algo] = words[0].lower()
+
+    return result
+
+
+def _deb_control(filepath):
+    """Return the fields of the control file in the `.deb` package `filepath`, as a dict."""
+    import tarfile
+    from cStringIO import StringIO
+
+    with closing(io.open(filepath, 'rb')) as handle:
+        if handle.read(8) != "!<arch>\n":
+            raise dputhelper.DputUploadFatalException("%s is not a Debian package" % filepath)
+        while True:
+            header = handle.read(60)
+            if len(header) < 60:
+                raise dputhelper.DputUploadFatalException("No control data found in %s" % filepath)
+            name, size = header[:16].strip().rstrip('/'), int(header[48:58].strip(), 10)
+            if name.startswith("control.tar"):
+                data = handle.read(size)
+                break
+            handle.seek(size + size % 2, os.SEEK_CUR)
+
+    if name.endswith(".xz") or name.endswith(".zst"):
+        import subprocess
+
+        command = ["zstd", "-dcq"] if name.endswith(".zst") else ["xz", "-dcq"]
+        proc = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        data = proc.communicate(data)[0]
+        if proc.returncode:
+            raise dputhelper.DputUploadFatalException("'%s' failed for %s" % (" ".join(command), filepath))
+
+    with closing(tarfile.open(fileobj=StringIO(data))) as archive:
+        for member in archive.getmembers():
+            if member.name.lstrip('./') == "control":
+                control = archive.extractfile(member).read().decode('utf-8', 'replace')
+                return dict([(key.lower().replace('-', '_'), val.strip())
+                    for key, val in rfc2822_parser.HeaderParser().parsestr(control.encode('utf-8')).items()
+                ])
+    raise dputhelper.DputUploadFatalException("No control file found in %s" % filepath)
+
+
+def _deb_matrix_params(matrix_params, filepath, distribution, component):
+    """ Return `matrix_params` with the `deb.*` properties that fit the package `filepath`.
+
+        A distribution or component already given in `matrix_params` is kept,
+        else the passed defaults are used. The architecture is taken from the package.
+    """
+    params = [i for i in matrix_params.split(';') if i]
+    given = lambda key: [i for i in params if i.split('=', 1)[0] == key]
+    result = [i for i in params if i.split('=', 1)[0] not in DEB_PROPERTIES]
+    result.extend(given("deb.distribution") or ["deb.distribution=" + i for i in distribution.split()])
+    result.extend(given("deb.component") or ["deb.component=" + component])
+    result.append("deb.architecture=" + _deb_control(filepath).get("architecture", "all"))
+    return ';'.join(result)
+
+
+def _resolve_incoming(fqdn, login, incoming, changes=None, cli_params=None, repo_mappings=""):
+    """Resolve the given `incoming` value to a working URL."""
+    # Build fully qualified URL
+    scheme, netloc, path, matrix_params, query, anchor = urlparse.urlparse(incoming, scheme="http", allow_fragments=True)
+    if scheme not in ("http", "https"):
+        raise dputhelper.DputUploadFatalException("Unsupported URL scheme '%s'" % scheme)
+    url = urlparse.urlunparse((scheme, netloc or fqdn, path.rstrip('/') + '/', '', query, None))
+
+    # Parse anchor to parameters
+    url_params = dict(_parse_qsl(anchor or ''))
+
+    # Read changes from stream or file, unless already parsed
+    pkgdata = {}
+    if isinstance(changes, dict):
+        pkgdata = dict(changes)
+    elif changes:
+        pkgdata = _parse_changes(changes)
 
     # Extend changes metadata
     pkgdata["loginuser"] = login.split(':')[0]
@@ -172,12 +394,14 @@ def _resolve_incoming(fqdn, login, incoming, changes=None, cli_params=None, repo
             pkgdata["epoch"], pkgdata["upstream"] = pkgdata["upstream"].split(':', 1)
     pkgdata.update(dict(
         fqdn=fqdn, repo=_distro2repo(pkgdata.get("distribution", "unknown"), repo_mappings),
+        deb_component="main", pool_prefix=re.sub(r"^(lib.|.).*", r"\1", pkgdata.get("source", "")),
     ))
     pkgdata.update(cli_params or {}) # CLI options can overwrite anything
-    trace("Collected metadata:\n    %(meta)s", meta="\n    ".join(["%s = %s" % (key, val)
-        for key, val in sorted(pkgdata.items())
-        if '\n' not in val # only print 'simple' values
-    ]))
+    if trace.debug:
+        trace("Collected metadata:\n    %(meta)s", meta="\n    ".join(["%s = %s" % (key, val)
+            for key, val in sorted(pkgdata.items())
+            if '\n' not in val # only print 'simple' values
+        ]))
 
     # Interpolate `url`
     try:
@@ -197,15 +421,85 @@ def _resolve_incoming(fqdn, login, incoming, changes=None, cli_params=None, repo
     return url, matrix_params, url_params
 
 
-def _url_connection(url, method, skip_host=False, skip_accept_encoding=False):
-    """Create HTTP[S] connection for `url`."""
+class ConnectionPool(object):
+    """ Keep-alive HTTP[S] connections per host, shared by all requests of an upload.
+
+        Idle connections the server closed in the meantime are detected before reuse,
+        and replaced by a fresh one.
+    """
+
+    def __init__(self):
+        self.idle = {}
+        self.lock = threading.Lock()
+        self.opened = 0
+        self.requests = 0
+
+    def acquire(self, url):
+        """Return an open connection to the host of `url`, reusing an idle one if possible."""
+        scheme, netloc = urlparse.urlparse(url)[:2]
+        key = scheme, netloc
+        with self.lock:
+            self.requests += 1
+            idle = self.idle.get(key, [])
+            while idle:
+                conn = idle.pop()
+                if not _connection_dropped(conn):
+                    conn.reused = True
+                    return conn
+                trace("Discarding connection to %(netloc)s closed by server", netloc=netloc)
+                conn.close()
+
+        conn = (httplib.HTTPSConnection if scheme == "https" else httplib.HTTPConnection)(netloc)
+        conn.pool_key, conn.reused = key, False
+        with timed("connect", host=netloc, tls=scheme == "https"):
+            conn.connect()
+        with self.lock:
+            self.opened += 1
+            trace("Opened connection #%(count)d to %(netloc)s", count=self.opened, netloc=netloc)
+        return conn
+
+    def release(self, conn, resp=None):
+        """Keep `conn` for later reuse, if its last response `resp` was read completely."""
+        if resp is None or not resp.isclosed() or resp.will_close or conn.sock is None:
+            conn.close()
+        else:
+            with self.lock:
+                self.idle.setdefault(conn.pool_key, []).append(conn)
+
+    def close(self):
+        """Close all idle connections."""
+        with self.lock:
+            for conns in self.idle.values():
+                for conn in conns:
+                    conn.close()
+            self.idle.clear()
+
+
+def _connection_dropped(conn):
+    """Check if an idle keep-alive connection was closed by the other end."""
+    if getattr(conn, "sock", None) is None:
+        return True
+    try:
+        # An idle connection must not have anything to read, except the EOF of a closed socket
+        return bool(select.select([conn.sock], [], [], 0)[0])
+    except (select.error, socket.error, ValueError):
+        return True
+
+
+def _url_connection(url, method, skip_host=False, skip_accept_encoding=False, pool=None):
+    """Create HTTP[S] connection for `url`, or get one from `pool`."""
     scheme, netloc, path, params, query, _ = urlparse.urlparse(url)
-    result = conn = (httplib.HTTPSConnection if scheme == "https" else httplib.HTTPConnection)(netloc)
+    if pool:
+        result = conn = pool.acquire(url)
+    else:
+        result = conn = (httplib.HTTPSConnection if scheme == "https" else httplib.HTTPConnection)(netloc)
+        conn.reused = False
     try:
         conn.debuglevel = int(trace.debug)
         conn.putrequest(method, urlparse.urlunparse((None, None, path, params, query, None)), skip_host, skip_accept_encoding)
         conn.putheader("User-Agent", "dput")
-        conn.putheader("Connection", "close")
+        if not pool:
+            conn.putheader("Connection", "close")
         conn = None  # return open connections as result
     finally:
         if conn:
@@ -214,74 +508,704 @@ def _url_connection(url, method, skip_host=False, skip_accept_encoding=False):
     return result
 
 
+def _release_connection(conn, resp=None, pool=None):
+    """Hand `conn` back to `pool` for reuse, or close it."""
+    if pool:
+        pool.release(conn, resp)
+    else:
+        conn.close()
+
+
+def _http_request(url, method, login, headers=None, send_body=None, pool=None):
+    """ Send an authenticated `method` request for `url`, and return the connection and response.
+
+        `send_body` is called with the connection to stream any request body.
+        A reused connection that was dropped by the server is replaced, and the request repeated.
+    """
+    while True:
+        conn = _url_connection(url, method, pool=pool)
+        resp = None
+        try:
+            try:
+                conn.putheader("Authorization", 'Basic %s' % login.encode('base64').replace('\n', '').strip())
+                for name, value in headers or []:
+                    conn.putheader(name, value)
+                conn.endheaders()
+                if send_body:
+                    send_body(conn)
+                with timed("first_byte", method=method):
+                    resp = conn.getresponse()
+            except (socket.error, httplib.BadStatusLine), exc:
+                if not conn.reused:
+                    raise
+                trace("Kept-alive connection was dropped (%(exc)s), reconnecting...", exc=exc)
+        finally:
+            if resp is None:
+                conn.close()
+
+        if resp is not None:
+            return conn, resp
+
+
+class UploadProgress(object):
+    """Report the progress of files uploaded one after the other, each on its own line."""
+
+    def __init__(self, ptype=None, stream=None):
+        self.ptype = ptype
+        self.stream = stream or sys.stdout
+
+    def start(self, filepath):
+        """Announce the upload of `filepath`."""
+        self.stream.write("  Uploading %s: " % os.path.basename(filepath))
+        self.stream.flush()
+
+    def tracker(self, filepath, size):
+        """Return a callable that is passed the number of bytes of `filepath` sent so far, or None."""
+        if not self.ptype:
+            return None
+        return ProgressIndicator(self.ptype, self.stream, size)
+
+    def finish(self, filepath, status):
+        """Report the final `status` of uploading `filepath`."""
+        self.stream.write(" %s.\n" % status)
+        self.stream.flush()
+
+
+class ParallelUploadProgress(UploadProgress):
+    """ Report the progress of concurrent uploads.
+
+        Finished files are reported on their own line, while the progress of
+        all active ones is shown together on a status line (on terminals only).
+    """
+
+    def __init__(self, ptype=None, stream=None):
+        UploadProgress.__init__(self, ptype, stream)
+        self.lock = threading.Lock()
+        self.active = []
+        self.status = {}
+        self.tty = hasattr(self.stream, "isatty") and self.stream.isatty()
+
+    def start(self, filepath):
+        """Add `filepath` to the status line."""
+        with self.lock:
+            self.active.append(os.path.basename(filepath))
+            self._render()
+
+    def tracker(self, filepath, size):
+        """Return a callable that reports the bytes of `filepath` sent so far on the status line, or None."""
+        if not self.ptype:
+            return None
+        return ProgressIndicator(self.ptype, _ProgressStatus(self, os.path.basename(filepath)), size)
+
+    def update(self, filename, text):
+        """Set the progress of `filename` shown on the status line."""
+        with self.lock:
+            self.status[filename] = text
+            self._render()
+
+    def finish(self, filepath, status):
+        """Report the final `status` of `filepath`, and remove it from the status line."""
+        filename = os.path.basename(filepath)
+        with self.lock:
+            if filename in self.active:
+                self.active.remove(filename)
+            self.status.pop(filename, None)
+            self._render(clear_only=True)
+            self.stream.write("  Uploading %s: %s.\n" % (filename, status))
+            self._render()
+
+    def _render(self, clear_only=False):
+        """Redraw the status line (lock must be held)."""
+        if self.tty:
+            line = "" if clear_only else ", ".join(
+                ("%s %s" % (i, self.status.get(i, ""))).strip() for i in self.active)
+            self.stream.write("\r" + line[:159] + "\x1b[K")
+        self.stream.flush()
+
+
+class ProgressIndicator(object):
+    """ Show how much of a file was sent so far, like dput's `FileWithProgress` does
+        (1 = spinner, 2 = KiB counter), but driven by the bytes actually sent.
+    """
+
+    SPINNER = "|/-\\"
+
+    def __init__(self, ptype, stream, size):
+        self.ptype = ptype
+        self.stream = stream
+        self.size = size
+        self.count = 0
+        self.shown = 0
+        self.spin = 0
+
+    def __call__(self, nbytes):
+        """Add `nbytes` sent, and update the indicator every KiB."""
+        self.count += nbytes
+        if self.count - self.shown <= 1024:
+            return
+        if self.ptype == 1:
+            self.spin = (self.spin + 1) % len(self.SPINNER)
+            self.stream.write((self.shown != 0) * "\b" + self.SPINNER[self.spin])
+        elif self.ptype == 2:
+            text = "%dk/%dk" % (self.count // 1024, self.size // 1024)
+            self.stream.write(text + "\b" * len(text))
+        self.stream.flush()
+        self.shown = self.count
+
+
+class _ProgressStatus(object):
+    """Stream handed to `ProgressIndicator`, feeding the status line of a `ParallelUploadProgress`."""
+
+    def __init__(self, board, filename):
+        self.board = board
+        self.filename = filename
+
+    def write(self, text):
+        """Take the latest progress indicator, without its backspaces."""
+        text = text.replace('\b', '').strip()
+        if text:
+            self.board.update(self.filename, text)
+
+    def flush(self):
+        """Nothing to do, updates are rendered immediately."""
+        pass
+
+
+class _TargetProgress(object):
+    """Report progress of uploads to one of several targets, via a shared reporter."""
+
+    def __init__(self, reporter, name):
+        self.reporter = reporter
+        self.name = name
+        self.ptype = reporter.ptype
+        self.stream = reporter.stream
+
+    def label(self, filepath):
+        """Return the name `filepath` is reported with."""
+        return "%s @ %s" % (os.path.basename(filepath), self.name)
+
+    def start(self, filepath):
+        """Announce the upload of `filepath`."""
+        self.reporter.start(self.label(filepath))
+
+    def tracker(self, filepath, size):
+        """Return a callable that is passed the number of bytes of `filepath` sent so far, or None."""
+        return self.reporter.tracker(self.label(filepath), size)
+
+    def finish(self, filepath, status):
+        """Report the final `status` of uploading `filepath`."""
+        self.reporter.finish(self.label(filepath), status)
+
+
+class SharedFile(object):
+    """ A file opened once, that can be read from several threads at the same time.
+
+        Reading is done at explicit offsets, from a memory map where possible.
+    """
+
+    def __init__(self, filepath):
+        self.name = filepath
+        self.handle = io.open(filepath, 'rb')
+        self.size = os.fstat(self.handle.fileno()).st_size
+        self.lock = threading.Lock()
+        self.data = None
+        if self.size:
+            try:
+                self.data = mmap.mmap(self.handle.fileno(), 0, access=mmap.ACCESS_READ)
+            except (EnvironmentError, mmap.error), exc:
+                trace("Cannot mmap %(filename)s (%(exc)s), reading it instead", filename=filepath, exc=exc)
+
+    def fileno(self):
+        """Return the file descriptor, for `sendfile`."""
+        return self.handle.fileno()
+
+    def read_at(self, offset, size):
+        """Return up to `size` bytes starting at `offset`."""
+        if self.data is not None and offset + size <= len(self.data):
+            return buffer(self.data, offset, size)
+        with self.lock:
+            self.handle.seek(offset)
+            return self.handle.read(size)
+
+    def close(self):
+        """Release the memory map and file."""
+        if self.data is not None:
+            self.data.close()
+        self.handle.close()
+
+
+def _run_parallel(func, items, workers):
+    """ Call `func` for each of `items`, using up to `workers` threads.
+
+        After the first failure no further calls are started, and that error
+        is re-raised after all running calls have finished.
+    """
+    if workers <= 1 or len(items) <= 1:
+        for item in items:
+            func(item)
+        return
+
+    lock = threading.Lock()
+    pending = iter(items)
+    errors = []
+
+    def worker():
+        "Process items until all are done, or something failed."
+        while not errors:
+            with lock:
+                try:
+                    item = pending.next()
+                except StopIteration:
+                    break
+            try:
+                func(item)
+            except: # pylint: disable=bare-except
+                errors.append(sys.exc_info())
+
+    threads = [threading.Thread(target=worker) for _ in range(min(workers, len(items)))]
+    for thread in threads:
+        thread.start()
+    try:
+        for thread in threads:
+            while thread.isAlive():
+                thread.join(0.25)  # stay responsive to Ctrl-C
+    except KeyboardInterrupt:
+        errors.append(sys.exc_info())
+        raise
+
+    if errors:
+        raise errors[0][0], errors[0][1], errors[0][2]
+
+
+class RetryPolicy(object):
+    """ Decide when to repeat failed uploads, using exponential backoff with jitter.
+
+        Files of at least `resume_threshold` bytes are resumed from what the server
+        already received, if it supports partial PUTs, instead of being sent again.
+    """
+
+    def __init__(self, retries=3, delay=1.0, max_delay=60.0, resume_threshold=64 * 1024 * 1024):
+        self.retries = retries
+        self.delay = delay
+        self.max_delay = max_delay
+        self.resume_threshold = resume_threshold
+
+    def backoff(self, attempt, retry_after=None):
+        """Return seconds to wait before retry number `attempt`, honoring a `Retry-After` header value."""
+        if retry_after:
+            retry_after = retry_after.strip()
+            if retry_after.isdigit():
+                return float(retry_after)
+            timestamp = rfc2822_utils.parsedate_tz(retry_after)
+            if timestamp:
+                return max(0.0, rfc2822_utils.mktime_tz(timestamp) - time.time())
+
+        delay = min(self.max_delay, self.delay * 2 ** (attempt - 1))
+        return delay / 2 + random.uniform(0, delay / 2)
+
+
 def _file_url(filepath, url):
     """Return URL for the given `filepath` in the DAV collection `url`."""
     basename = os.path.basename(filepath)
     return urlparse.urljoin(url.rstrip('/') + '/', basename)
 
 
-def _dav_put(filepath, url, matrix_params, login, progress=None):
-    """Upload `filepath` to given `url` (referring to a WebDAV collection)."""
+def _hash_blocks(hashval, data, size):
+    """Feed `size` bytes of the buffer `data` to `hashval`, in blocks large enough to release the GIL."""
+    for offset in xrange(0, size, HASH_BLOCK_SIZE):
+        hashval.update(buffer(data, offset, HASH_BLOCK_SIZE))
+
+
+def _file_checksums(filepath, known=None):
+    """ Return a dict of hex digests for `filepath`, for all of `CHECKSUM_ALGOS`.
+
+        Digests in `known` (e.g. taken from the changes file) are trusted when
+        their recorded size matches, only missing ones are computed. The file
+        is read at most once, via a shared memory map that all digest threads
+        consume in parallel.
+    """
+    size = os.path.getsize(filepath)
+    result = {}
+    if known and known.get("size") == size:
+        result = dict((algo, known[algo]) for algo in CHECKSUM_ALGOS if known.get(algo))
+    missing = [algo for algo in CHECKSUM_ALGOS if algo not in result]
+    if not missing:
+        trace("Using checksums from changes for %(filename)s", filename=os.path.basename(filepath))
+        return result
+
+    hashes = dict([(x, getattr(hashlib, x)()) for x in missing])
+    with timed("hashing", file=os.path.basename(filepath)) as info:
+        info["bytes"] = size
+        if size:
+            _hash_file(filepath, size, hashes)
+
+    result.update((algo, hashval.hexdigest()) for algo, hashval in hashes.items())
+    return result
+
+
+def _hash_file(filepath, size, hashes):
+    """Feed the `size` bytes of `filepath` to all `hashes`, reading it only once."""
+    with closing(io.open(filepath, 'rb')) as handle:
+        try:
+            data = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+        except (EnvironmentError, mmap.error), exc:
+            # Not mappable (e.g. a pipe or special filesystem), fall back to large buffered reads
+            trace("Cannot mmap %(filename)s (%(exc)s), reading it instead", filename=filepath, exc=exc)
+            while True:
+                block = handle.read(HASH_BLOCK_SIZE)
+                if not block:
+                    break
+                for hashval in hashes.values():
+                    hashval.update(block)
+        else:
+            try:
+                workers = [threading.Thread(target=_hash_blocks, args=(hashval, data, size))
+                    for hashval in hashes.values()]
+                for worker in workers:
+                    worker.start()
+                for worker in workers:
+                    worker.join()
+            finally:
+                data.close()
+
+
+def _dav_put(filepath, url, matrix_params, login, progress=None, # pylint: disable=too-many-arguments
+        checksums=None, pool=None, reporter=None, checksum_deploy=False, retry=None, source=None, offset=0):
+    """ Upload `filepath` to given `url` (referring to a WebDAV collection).
+
+        Pass the file's `checksums` if already known, else they're computed before sending.
+        The contents are read from `source`, a `SharedFile` of `filepath`, when given.
+        A non-zero `offset` continues an upload the server already stores that many bytes of;
+        the result is checked afterwards, and the whole file sent if the server's copy is broken.
+        With `checksum_deploy`, Artifactory is first asked to deploy the file from content
+        it already stores, and the file is only sent when that content is unknown.
+        Transient failures are retried according to the `retry` policy.
+
+        Returns the number of bytes actually transferred.
+    """
     fileurl = _file_url(filepath, url)
     if matrix_params:
         fileurl += ';' + matrix_params
-    sys.stdout.write("  Uploading %s: " % os.path.basename(filepath))
-    sys.stdout.flush()
-    size = os.path.getsize(filepath)
+    reporter = reporter or UploadProgress(progress)
+    retry = retry or RetryPolicy(retries=0)
+    reporter.start(filepath)
+    size = source.size if source else os.path.getsize(filepath)
+    checksums = checksums or _file_checksums(filepath)
+
+    trace("HTTP PUT to URL: %(url)s", url=fileurl)
+
+    def body_sender(offset):
+        "Return a callable that streams the file contents, starting at `offset`."
+        def send_body(conn):
+            "Stream the file contents."
+            if source:
+                _send_file(conn, source, offset, size, reporter.tracker(filepath, size - offset))
+            else:
+                with closing(SharedFile(filepath)) as shared:
+                    _send_file(conn, shared, offset, size, reporter.tracker(filepath, size - offset))
+        return send_body
 
-    hashes = dict([(x, getattr(hashlib, x)()) for x in ("md5", "sha1", "sha256")])
-    with closing(io.open(filepath, 'rb')) as handle:
-        while True:
-            data = handle.read(CHUNK_SIZE)
-            if not data:
-                break
-            for hashval in hashes.values():
-                hashval.update(data)
+    def put(headers, send_body=None):
+        "Send a PUT request, and return its response."
+        conn, resp = _http_request(fileurl, "PUT", login, headers=headers, send_body=send_body, pool=pool)
+        try:
+            resp.read() # eat response body
+        finally:
+            _release_connection(conn, resp, pool)
+        return resp
 
-    with closing(io.open(filepath, 'rb')) as handle:
+    headers = [("X-Checksum-" + algo.capitalize(), checksums[algo]) for algo in CHECKSUM_ALGOS]
+    try:
+        resp, deploy = None, checksum_deploy and not offset
+        attempt, transferred = 0, 0
+        while resp is None:
+            try:
+                if deploy:
+                    resp = put(headers + [("Content-Length", "0"), ("X-Checksum-Deploy", "true")])
+                    if 200 <= resp.status <= 299:
+                        reporter.finish(filepath, "deployed by checksum")
+                        return 0
+                    elif resp.status == 404:
+                        trace("Content of %(filename)s unknown to server, sending it", filename=os.path.basename(filepath))
+                        deploy, resp = False, None
+                        continue
+                elif offset:
+                    # The checksums are those of the whole file, which the server then verifies
+                    resp = put(headers + [("Content-Length", str(size - offset)),
+                                ("Content-Range", "bytes %d-%d/%d" % (offset, size - 1, size))],
+                        send_body=body_sender(offset))
+                    transferred += size - offset
+                    if resp.status in (400, 405, 409, 411, 416, 501):
+                        trace("Server rejected partial PUT (%(status)d), sending whole file", status=resp.status)
+                        offset, resp = 0, None
+                        continue
+                    # Not every server checks the result, so only a verified copy counts as done
+                    if 200 <= resp.status <= 299 and _stored_size(_file_url(filepath, url), filepath, size,
+                            checksums, login, pool) != size:
+                        log("WARN: Continuing the upload of %(filename)s left a broken copy, sending the whole file",
+                            filename=os.path.basename(filepath))
+                        offset, resp = 0, None
+                        continue
+                else:
+                    resp = put(headers + [("Content-Length", str(size))], send_body=body_sender(0))
+                    transferred += size
+                error, retry_after = "HTTP status %d %s" % (resp.status, resp.reason), resp.getheader("Retry-After")
+                if resp.status not in RETRY_STATUS or attempt >= retry.retries:
+                    break
+            except (socket.error, httplib.HTTPException), exc:
+                if attempt >= retry.retries:
+                    raise
+                error, retry_after = exc, None
+
+            attempt += 1
+            delay = retry.backoff(attempt, retry_after)
+            log("WARN: Uploading %(filename)s failed (%(error)s), retry %(attempt)d of %(retries)d in %(delay).1f secs",
+                filename=os.path.basename(filepath), error=error, attempt=attempt, retries=retry.retries, delay=delay)
+            time.sleep(delay)
+            resp = None
+
+            if not deploy and size >= retry.resume_threshold:
+                offset = _stored_size(_file_url(filepath, url), filepath, size, checksums, login, pool)
+                if offset == size:
+                    reporter.finish(filepath, "done (already complete)")
+                    return transferred
+    except (socket.error, EnvironmentError, httplib.HTTPException), exc:
+        reporter.finish(filepath, "failed")
+        if isinstance(exc, httplib.HTTPException):
+            raise urllib2.URLError(exc)
+        raise
+
+    if 200 <= resp.status <= 299:
+        reporter.finish(filepath, "done")
+    #elif res.status == 401 and not auth_headers:
+        #print "need authentication."
+        #auth_headers = AuthHandlerHackAround(url, res.msg, pwman).get_auth_headers()
+    elif resp.status == 401:
+        reporter.finish(filepath, "unauthorized")
+        raise urllib2.URLError("Upload failed as unauthorized (%s),"
+            " maybe wrong username or password?" % resp.reason)
+    else:
+        reporter.finish(filepath, "failed")
+        raise urllib2.URLError("Unexpected HTTP status %d %s" % (resp.status, resp.reason))
+
+    return transferred
+
+
+def _bundle_layout(filepaths):
+    """ Return the members of a tar archive holding `filepaths`, and its total size.
+
+        Members are `(filepath, header, size, padding)` tuples, streamed by `_send_bundle`.
+    """
+    import tarfile
+
+    members, total = [], 2 * tarfile.BLOCKSIZE  # end-of-archive marker
+    for filepath in filepaths:
+        info = tarfile.TarInfo(os.path.basename(filepath))
+        stat = os.stat(filepath)
+        info.size, info.mtime, info.mode = stat.st_size, int(stat.st_mtime), 0644
+        header = info.tobuf()
+        padding = -info.size % tarfile.BLOCKSIZE
+        members.append((filepath, header, info.size, padding))
+        total += len(header) + info.size + padding
+    return members, total
+
+
+def _send_bundle(conn, members, progress=None):
+    """Stream a tar archive of the `_bundle_layout` members over `conn`, without writing it anywhere."""
+    import tarfile
+
+    for filepath, header, size, padding in members:
+        conn.send(header)
+        with closing(SharedFile(filepath)) as source:
+            if source.size != size:
+                raise EnvironmentError("%s changed while uploading it" % filepath)
+            _send_file(conn, source, 0, size, progress)
+        conn.send('\0' * padding)
         if progress:
-            handle = dputhelper.FileWithProgress(handle, ptype=progress, progressf=sys.stdout, size=size)
-        trace("HTTP PUT to URL: %s" % fileurl)
+            progress(len(header) + padding)
+    conn.send('\0' * (2 * tarfile.BLOCKSIZE))
+
+
+def _dav_put_bundle(filepaths, url, matrix_params, login, reporter, pool=None): # pylint: disable=too-many-arguments
+    """ Upload all `filepaths` to given `url` in a single request, as an archive Artifactory explodes.
+
+        Returns the number of bytes transferred, or None when the server didn't accept the
+        archive, and the files have to be uploaded one by one.
+    """
+    name = os.path.splitext(os.path.basename(filepaths[-1]))[0] + ".tar"
+    fileurl = _file_url(name, url)
+    if matrix_params:
+        fileurl += ';' + matrix_params
+    members, size = _bundle_layout(filepaths)
+
+    trace("HTTP PUT of %(count)d files as %(size)d bytes archive to URL: %(url)s",
+        count=len(members), size=size, url=fileurl)
+    reporter.start(name)
+    try:
+        conn, resp = _http_request(fileurl, "PUT", login, headers=[
+                ("Content-Type", "application/x-tar"), ("Content-Length", str(size)), ("X-Explode-Archive", "true"),
+            ], send_body=lambda conn: _send_bundle(conn, members, reporter.tracker(name, size)), pool=pool)
+        try:
+            resp.read() # eat response body
+        finally:
+            _release_connection(conn, resp, pool)
+    except (socket.error, httplib.HTTPException), exc:
+        reporter.finish(name, "failed")
+        log("WARN: Uploading the files as %(name)s failed (%(exc)s), sending them one by one", name=name, exc=exc)
+        return None
+
+    if 200 <= resp.status <= 299:
+        reporter.finish(name, "done")
+        return size
+    elif resp.status == 401:
+        reporter.finish(name, "unauthorized")
+        raise urllib2.URLError("Upload failed as unauthorized (%s),"
+            " maybe wrong username or password?" % resp.reason)
+
+    reporter.finish(name, "rejected")
+    log("WARN: Server rejected the archive %(name)s (HTTP status %(status)d %(reason)s), sending files one by one",
+        name=name, status=resp.status, reason=resp.reason)
+    return None
+
+
+def _send_file(conn, source, offset, size, progress=None):
+    """ Send the contents of the `SharedFile` `source` from `offset` up to `size` over `conn`.
+
+        Plain HTTP connections pass the file to the socket via `sendfile`, where available.
+        Otherwise, the file is copied in blocks sized to the measured throughput.
+        `progress` is called with the number of bytes of each sent block.
+    """
+    sendfile = None if isinstance(conn, httplib.HTTPSConnection) else _sendfile()
+    if sendfile:
+        offset = _send_file_zerocopy(sendfile, conn.sock, source, offset, size, progress)
+
+    chunk = CHUNK_SIZE
+    conn.debuglevel = 0
+    try:
+        while offset < size:
+            data = source.read_at(offset, min(chunk, size - offset))
+            if not data:
+                raise EnvironmentError("%s got truncated while uploading it" % source.name)
+            started = time.time()
+            conn.send(data)
+            offset += len(data)
+            if progress:
+                progress(len(data))
+            chunk = _next_chunk_size(chunk, len(data), time.time() - started)
+    finally:
+        conn.debuglevel = int(trace.debug)
+
+
+def _send_file_zerocopy(sendfile, sock, source, offset, size, progress=None):
+    """ Send `source` from `offset` on via `sendfile`, and return the offset reached.
+
+        That is `size`, unless `sendfile` can't handle this kind of file
+        right from the start, in which case the caller has to copy the rest.
+    """
+    import errno
 
+    while offset < size:
         try:
-            conn = _url_connection(fileurl, "PUT")
+            sent = sendfile(sock.fileno(), source.fileno(), offset, min(SENDFILE_BLOCK, size - offset))
+        except OSError, exc:
+            if exc.errno in (errno.EAGAIN, errno.EINTR):
+                select.select([], [sock], [], None)  # socket has a timeout, wait until it's writable
+                continue
+            if exc.errno in (errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP) and offset == 0:
+                trace("sendfile() not possible (%(exc)s), copying instead", exc=exc)
+                return offset
+            raise socket.error(exc.errno, exc.strerror)
+        if not sent:
+            raise EnvironmentError("%s got truncated while uploading it" % source.name)
+        offset += sent
+        if progress:
+            progress(sent)
+
+    return offset
+
+
+def _next_chunk_size(chunk, nbytes, seconds):
+    """Return the block size for sending, given it took `seconds` to send `nbytes` of a `chunk` sized block."""
+    wanted = nbytes / seconds * CHUNK_SECONDS if seconds > 0 else MAX_CHUNK_SIZE
+    if nbytes == chunk and wanted >= 2 * chunk and chunk < MAX_CHUNK_SIZE:
+        chunk *= 2  # grow gradually, the first sends only fill the socket buffer
+    while wanted < chunk / 2 and chunk > CHUNK_SIZE:
+        chunk //= 2
+    return chunk
+
+
+def _sendfile():
+    """ Return `os.sendfile`, or the same function of libc on Linux, or None if neither is available.
+
+        (The libc function is used on Python 2, which has no `os.sendfile`.)
+    """
+    if not hasattr(_sendfile, "func"):
+        _sendfile.func = getattr(os, "sendfile", None)
+        if _sendfile.func is None and sys.platform.startswith("linux"):
             try:
-                conn.putheader("Authorization", 'Basic %s' % login.encode('base64').replace('\n', '').strip())
-                conn.putheader("Content-Length", str(size))
-                for algo, hashval in hashes.items():
-                    conn.putheader("X-Checksum-" + algo.capitalize(), hashval.hexdigest())
-                conn.endheaders()
+                import ctypes
 
-                conn.debuglevel = 0
-                while True:
-                    data = handle.read(CHUNK_SIZE)
-                    if not data:
-                        break
-                    conn.send(data)
-                conn.debuglevel = int(trace.debug)
-
-                resp = conn.getresponse()
-                if 200 <= resp.status <= 299:
-                    print(" done.")
-                #elif res.status == 401 and not auth_headers:
-                    #print "need authentication."
-                    #auth_headers = AuthHandlerHackAround(url, res.msg, pwman).get_auth_headers()
-                elif resp.status == 401:
-                    print(" unauthorized.")
-                    raise urllib2.URLError("Upload failed as unauthorized (%s),"
-                        " maybe wrong username or password?" % resp.reason)
-                else:
-                    print(" failed.")
-                    raise urllib2.URLError("Unexpected HTTP status %d %s" % (resp.status, resp.reason))
+                libc = ctypes.CDLL(None, use_errno=True)
+                libc_sendfile = libc.sendfile64
+            except (ImportError, OSError, AttributeError), exc:
+                trace("No sendfile() available (%(exc)s)", exc=exc)
+            else:
+                libc_sendfile.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.POINTER(ctypes.c_int64), ctypes.c_size_t]
+                libc_sendfile.restype = ctypes.c_ssize_t
 
-                resp.read() # eat response body
-            finally:
-                conn.close()
-        except httplib.HTTPException, exc:
-            raise urllib2.URLError(exc)
+                def sendfile(out_fd, in_fd, offset, count):
+                    "Call libc's `sendfile`, with the signature of `os.sendfile`."
+                    result = libc_sendfile(out_fd, in_fd, ctypes.byref(ctypes.c_int64(offset)), count)
+                    if result < 0:
+                        err = ctypes.get_errno()
+                        raise OSError(err, os.strerror(err))
+                    return result
+
+                _sendfile.func = sendfile
 
+    return _sendfile.func
 
-def _check_url(url, login, allowed, mindepth=0):
+
+def _stored_size(fileurl, filepath, size, checksums, login, pool=None):
+    """ Return how many bytes of `filepath` the server already stores at `fileurl`.
+
+        A complete copy is only accepted when its SHA1 matches, and a partial one
+        only when its last bytes match the local file; otherwise 0 is returned.
+    """
+    try:
+        conn, resp = _http_request(fileurl, "HEAD", login, pool=pool)
+        try:
+            resp.read()
+        finally:
+            _release_connection(conn, resp, pool)
+        stored = int(resp.getheader("Content-Length") or "0", 10)
+        if resp.status != 200 or not 0 < stored <= size:
+            return 0
+        if stored == size:
+            return stored if resp.getheader("X-Checksum-Sha1") == checksums["sha1"] else 0
+
+        start = max(0, stored - RESUME_VERIFY_SIZE)
+        conn, resp = _http_request(fileurl, "GET", login, pool=pool,
+            headers=[("Range", "bytes=%d-%d" % (start, stored - 1))])
+        try:
+            remote = resp.read()
+        finally:
+            _release_connection(conn, resp, pool)
+        if resp.status != 206:
+            return 0
+        with closing(io.open(filepath, 'rb')) as handle:
+            handle.seek(start)
+            if handle.read(stored - start) != remote:
+                return 0
+    except (socket.error, ValueError, httplib.HTTPException), exc:
+        trace("Cannot determine stored size of %(url)s: %(exc)s", url=fileurl, exc=exc)
+        return 0
+
+    trace("Server has %(stored)d of %(size)d bytes for %(url)s", stored=stored, size=size, url=fileurl)
+    return stored
+
+
+def _check_url(url, login, allowed, mindepth=0, pool=None):
     """Check if HTTP GET `url` returns a status code in `allowed`."""
     if mindepth:
         scheme, netloc, path, params, query, fragment = urlparse.urlparse(url)
@@ -290,25 +1214,153 @@ def _check_url(url, login, allowed, mindepth=0):
 
     trace("Checking URL '%(url)s'", url=url)
     try:
-        # Could use a HTTPBasicAuthHandler here, but meh!
-        # Should use 'requests', but dependency hell.
-        request = urllib2.Request(url)
-        request.add_header("Authorization", 'Basic %s' % login.encode('base64').replace('\n', '').strip())
-        with closing(urllib2.urlopen(request)) as handle:
-            handle.read()
-            code = handle.code
-            if code not in allowed:
-                raise urllib2.HTTPError(url, code,
-                    "Unallowed HTTP status %d (%s)" % (code, handle.msg),
-                    handle.headers, None)
-    except urllib2.HTTPError, exc:
-        code = exc.code
-        if code not in allowed:
-            raise
+        conn, resp = _http_request(url, "GET", login, pool=pool)
+        try:
+            resp.read()
+        finally:
+            _release_connection(conn, resp, pool)
+    except httplib.HTTPException, exc:
+        raise urllib2.URLError(exc)
+
+    code = resp.status
+    if code not in allowed:
+        raise urllib2.HTTPError(url, code, "Unallowed HTTP status %d (%s)" % (code, resp.reason), resp.msg, None)
 
     trace("Code %(code)d OK for URL '%(url)s'", url=url, code=code)
 
 
+def _dav_listing(url, login, pool=None):
+    """ List the WebDAV collection `url` using a single "PROPFIND" request.
+
+        Returns a dict mapping member names to their `size` and `etag`
+        (`None` for sub-collections), or `None` if `url` doesn't exist.
+        Other failures raise `urllib2.HTTPError`.
+    """
+    trace("Listing collection '%(url)s'", url=url)
+    try:
+        conn, resp = _http_request(url, "PROPFIND", login, pool=pool, headers=[
+                ("Depth", "1"), ("Content-Type", 'application/xml; charset="utf-8"'),
+                ("Content-Length", str(len(PROPFIND_BODY))),
+            ], send_body=lambda conn: conn.send(PROPFIND_BODY))
+        try:
+            body = resp.read()
+        finally:
+            _release_connection(conn, resp, pool)
+    except httplib.HTTPException, exc:
+        raise urllib2.URLError(exc)
+
+    if resp.status == 404:
+        return None
+    if resp.status != 207:
+        raise urllib2.HTTPError(url, resp.status, "Listing failed with HTTP status %d (%s)" % (
+            resp.status, resp.reason), resp.msg, None)
+
+    result = _parse_multistatus(body, url)
+    trace("Collection '%(url)s' has %(count)d member(s)", url=url, count=len(result))
+    return result
+
+
+def _parse_multistatus(body, url):
+    """Parse a "PROPFIND" response `body` for collection `url` into a dict of members."""
+    from xml.etree import ElementTree
+    from xml.parsers import expat
+
+    result = {}
+    basepath = urllib2.unquote(urlparse.urlparse(url)[2]).rstrip('/')
+    try:
+        multistatus = ElementTree.fromstring(body)
+    except (SyntaxError, expat.ExpatError), exc:
+        raise urllib2.URLError("Malformed PROPFIND response for '%s': %s" % (url, exc))
+
+    for response in multistatus.findall("{DAV:}response"):
+        path = urllib2.unquote(urlparse.urlparse(response.findtext("{DAV:}href", "").strip())[2]).rstrip('/')
+        if not path or path == basepath:
+            continue  # the collection itself
+
+        props = {}
+        for propstat in response.findall("{DAV:}propstat"):
+            if " 200 " in propstat.findtext("{DAV:}status", " 200 "):
+                for prop in propstat.findall("{DAV:}prop/*"):
+                    props[prop.tag.replace("{DAV:}", "")] = (prop.text or "").strip(), prop
+
+        name = path.split('/')[-1]
+        if "resourcetype" in props and props["resourcetype"][1].find("{DAV:}collection") is not None:
+            result[name] = None
+        else:
+            size, etag = props.get("getcontentlength", ("",))[0], props.get("getetag", ("",))[0]
+            if etag.startswith("W/"):
+                etag = etag[2:]
+            result[name] = dict(size=int(size, 10) if size.isdigit() else None, etag=etag.strip('"').lower() or None)
+
+    return result
+
+
+def _preflight_checks(incoming, files_to_upload, changes_file, login, # pylint: disable=too-many-arguments
+        checksums_of, mindepth=0, overwrite=0, skip_identical=0, pool=None, stored=()):
+    """ Check the upload target, answering as much as possible from one collection listing.
+
+        `checksums_of` is called to get the digests of a local file, when needed.
+        Returns the files of `files_to_upload` that are already stored identically
+        on the server: those in `stored` (known from an earlier upload), and others
+        found in the listing (only with `skip_identical`).
+    """
+    checks = []
+
+    def check_overwrite():
+        "Check if .changes file already exists."
+        try:
+            _check_url(_file_url(changes_file, incoming), login, [404], pool=pool)
+        except urllib2.HTTPError, exc:
+            raise dputhelper.DputUploadFatalException("Overwriting existing changes at '%s' not allowed: %s" % (
+                _file_url(changes_file, incoming), exc))
+
+    def check_mindepth():
+        "Check for existence of target path with minimal depth."
+        try:
+            _check_url(incoming, login, range(200, 300), mindepth=mindepth, pool=pool)
+        except urllib2.HTTPError, exc:
+            raise dputhelper.DputUploadFatalException("Required repository path '%s' doesn't exist: %s" % (
+                exc.filename, exc))
+
+    try:
+        listing = _dav_listing(incoming, login, pool=pool)
+    except urllib2.HTTPError, exc:
+        # No WebDAV listings (e.g. Bintray), check each condition on its own
+        trace("Cannot list target collection (%(exc)s), checking URLs one by one", exc=exc)
+        if not overwrite and changes_file and changes_file not in stored:
+            checks.append(check_overwrite)
+        if mindepth:
+            checks.append(check_mindepth)
+        _run_parallel(lambda check: check(), checks, len(checks))
+        return list(stored)
+
+    if listing is None:
+        # A new collection, so nothing can be overwritten; only its parents might be missing
+        if mindepth:
+            check_mindepth()
+        return []
+
+    def is_identical(filepath):
+        "Check if the server already has the same content for `filepath`."
+        remote = listing.get(os.path.basename(filepath))
+        if not remote or remote["size"] != os.path.getsize(filepath) or not remote["etag"]:
+            return False
+        return remote["etag"] in checksums_of(filepath).values()
+
+    identical = list(stored)
+    if skip_identical:
+        for filepath in [i for i in files_to_upload if i not in stored and is_identical(i)]:
+            log("INFO: Skipping '%(filename)s', identical file already stored", filename=os.path.basename(filepath))
+            identical.append(filepath)
+
+    if (not overwrite and changes_file and os.path.basename(changes_file) in listing
+            and changes_file not in identical):
+        raise dputhelper.DputUploadFatalException("Overwriting existing changes at '%s' not allowed" % (
+            _file_url(changes_file, incoming),))
+
+    return identical
+
+
 def _get_host_argument(fqdn):
     """ We have to jump through several hoops to get to our config section,
         which in turn is the only place where the host argument is available.
@@ -326,6 +1378,11 @@ def _get_host_argument(fqdn):
     return result
 
 
+def _parse_host_argument(host_argument):
+    """Parse a "host:key=val;..." argument from the command line into a dict."""
+    return dict(_parse_qsl(host_argument.replace(',', ';')))
+
+
 def _get_config_data(fqdn):
     """Get configuration section for the chosen host, and CLI host parameters."""
     # Without the patch applied, fall back to ugly hacks
@@ -349,22 +1406,178 @@ def _get_config_data(fqdn):
         host_argument = _get_host_argument(fqdn)
         log("WARN: Extended host configuration not available!")
 
-    # Parse "host:key=val;..." argument from command line into a dict
-    cli_params = dict(cgi.parse_qsl(host_argument.replace(',', ';'), keep_blank_values=True))
+    return host_config, _parse_host_argument(host_argument)
 
-    return host_config, cli_params
 
+class UploadJournal(object):
+    """ Local record of the files of a changes set, and of their uploads.
 
-def upload(fqdn, login, incoming, files_to_upload, # pylint: disable=too-many-arguments
-        debug, dummy, progress=None):
-    """Upload the files via WebDAV."""
-    assert sys.version_info >= (2, 5), "Your snake is a rotting corpse (Python 2.5+ required)"
-    trace.debug = bool(debug)
+        Checksums are reused as long as a file's size and modification time are unchanged,
+        and uploads are keyed by their target URL, with the SHA256 of the content sent there.
+        When the database fails (e.g. on a full disk), the upload carries on without it.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS files (
+            path TEXT PRIMARY KEY,
+            size INTEGER,
+            mtime REAL,
+            md5 TEXT,
+            sha1 TEXT,
+            sha256 TEXT
+        );
+        CREATE TABLE IF NOT EXISTS uploads (
+            url TEXT PRIMARY KEY,
+            sha256 TEXT,
+            status TEXT,
+            updated REAL
+        );
+    """
+
+    def __init__(self, filename):
+        import sqlite3
+
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.failed = False
+        self.db = sqlite3.connect(filename, check_same_thread=False)
+        self.db.executescript(self.SCHEMA)
 
+    def _execute(self, sql, values=(), commit=False):
+        """Run a statement, and return its first result row; None after any database error."""
+        import sqlite3
+
+        with self.lock:
+            if self.failed:
+                return None
+            try:
+                row = self.db.execute(sql, values).fetchone()
+                if commit:
+                    self.db.commit()
+                return row
+            except sqlite3.Error, exc:
+                self.failed = True
+                log("WARN: Upload journal %(filename)s failed, continuing without it: %(exc)s",
+                    filename=self.filename, exc=exc)
+                return None
+
+    def checksums(self, filepath):
+        """Return the recorded checksums of `filepath`, or None if unknown or changed since."""
+        stat = os.stat(filepath)
+        row = self._execute("SELECT size, mtime, md5, sha1, sha256 FROM files WHERE path = ?",
+            (os.path.abspath(filepath),))
+        if row and row[0] == stat.st_size and row[1] == stat.st_mtime:
+            return dict(zip(CHECKSUM_ALGOS, row[2:]))
+        return None
+
+    def add_file(self, filepath, checksums):
+        """Record the `checksums` of `filepath`."""
+        stat = os.stat(filepath)
+        self._execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?)",
+            (os.path.abspath(filepath), stat.st_size, stat.st_mtime) + tuple(checksums[i] for i in CHECKSUM_ALGOS),
+            commit=True)
+
+    def uploaded(self, url):
+        """Return the SHA256 of the content last sent to `url`, or None."""
+        row = self._execute("SELECT sha256 FROM uploads WHERE url = ?", (url,))
+        return row and row[0]
+
+    def record(self, url, sha256, status):
+        """Record the `status` ("started" or "done") of uploading content `sha256` to `url`."""
+        self._execute("INSERT OR REPLACE INTO uploads VALUES (?, ?, ?, ?)", (url, sha256, status, time.time()),
+            commit=True)
+
+    def recorded(self):
+        """Return the number of recorded uploads."""
+        row = self._execute("SELECT COUNT(*) FROM uploads")
+        return row[0] if row else 0
+
+    def close(self, remove=False):
+        """Close the journal, and `remove` it (once the upload is complete); one without uploads is always removed."""
+        remove = remove or not (self.failed or self.recorded())
+        self.db.close()
+        if remove:
+            os.remove(self.filename)
+            trace("Removed upload journal %(filename)s", filename=self.filename)
+
+
+def _open_journal(changes_file):
+    """Open the upload journal of `changes_file`, or return None if that's not possible."""
+    filename = os.path.splitext(changes_file)[0] + JOURNAL_SUFFIX
     try:
-        host_config, cli_params = _get_config_data(fqdn)
-        login = _resolve_credentials(fqdn, login)
+        import sqlite3
+    except ImportError, exc:
+        trace("No upload journal (%(exc)s)", exc=exc)
+        return None
+
+    try:
+        journal = UploadJournal(filename)
+        if journal.recorded():
+            log("INFO: Continuing the upload recorded in %(filename)s", filename=filename)
+        return journal
+    except (sqlite3.Error, EnvironmentError), exc:
+        log("WARN: Cannot use upload journal %(filename)s: %(exc)s", filename=filename, exc=exc)
+        return None
+
 
+class UploadSession(object): # pylint: disable=too-many-instance-attributes
+    """ Credentials, options, and connections for uploading changes sets to one host.
+
+        Several changes sets can share a session (see `batch_upload`), which then
+        also limits the number of concurrent transfers over all of them.
+    """
+
+    def __init__(self, fqdn, login, incoming, host_config, cli_params, progress=None): # pylint: disable=too-many-arguments
+        self.fqdn = fqdn
+        self.incoming = incoming
+        self.host_config = host_config
+        self.cli_params = cli_params
+        with timed("credentials"):
+            self.login = _resolve_credentials(fqdn, login)
+        self.pool = ConnectionPool()
+
+        # Options come from host arguments, the `incoming` anchor, or the host config
+        self.params = dict(_parse_qsl(urlparse.urlparse(incoming, allow_fragments=True)[5] or ''))
+        self.params.update(cli_params)
+        self.workers = max(1, int(self.option("workers", "1"), 10))
+        self.retry = RetryPolicy(retries=int(self.option("retries", "3"), 10),
+            delay=float(self.option("retry_delay", "1")), max_delay=float(self.option("retry_max_delay", "60")),
+            resume_threshold=int(self.option("resume_threshold", "64"), 10) * 1024 * 1024)
+        self.slots = threading.BoundedSemaphore(self.workers)
+        self.reporter = (ParallelUploadProgress if self.workers > 1 else UploadProgress)(progress)
+        self.replicas = []
+
+    def add_replicas(self, config):
+        """ Add a session for each of the `fanout_hosts`, taken from the dput `config`.
+
+            Uploads then go to all of them at the same time, reading each file only once.
+        """
+        hosts = self.option("fanout_hosts", "").split()
+        if not hosts:
+            return
+        if config is None:
+            raise dputhelper.DputUploadFatalException("'fanout_hosts' needs the extended host configuration")
+        if self.option("fanout_required", "all") not in ("all", "primary"):
+            raise dputhelper.DputUploadFatalException("Bad 'fanout_required' value '%s', expected 'all' or 'primary'"
+                % self.option("fanout_required", "all"))
+
+        reporter = ParallelUploadProgress(self.reporter.ptype, self.reporter.stream)
+        for host in hosts:
+            if not config.has_section(host) or config.get(host, "method") != "webdav":
+                raise dputhelper.DputUploadFatalException("No 'webdav' host section '%s' for fan-out found" % host)
+            host_config = dict(config.items(host))
+            replica = UploadSession(host_config["fqdn"], host_config.get("login", ""), host_config["incoming"],
+                host_config, self.cli_params)
+            replica.reporter = _TargetProgress(reporter, replica.fqdn)
+            self.replicas.append(replica)
+        self.reporter = _TargetProgress(reporter, self.fqdn)
+
+    def option(self, name, default):
+        """Get the value of upload option `name`."""
+        return self.params.get(name, self.host_config.get(name, default))
+
+    def prepare(self, files_to_upload, pkgdata=None):
+        """Find the changes, and resolve the target URL for uploading `files_to_upload`."""
         # Handle .changes file
         changes_file = [i for i in files_to_upload if i.endswith(".changes")]
         if not changes_file:
@@ -376,54 +1589,248 @@ def upload(fqdn, login, incoming, files_to_upload, # pylint: disable=too-many-ar
                     " taking the 1st:\n    %(changes)s",
                     n=len(files_to_upload), changes="\n    ".join(changes_file))
             changes_file = changes_file[0]
+        if pkgdata is None:
+            pkgdata = changes_file and _parse_changes(changes_file) or {}
 
         # Prepare for uploading
-        incoming, matrix_params, repo_params = _resolve_incoming(fqdn, login, incoming, changes=changes_file,
-            cli_params=cli_params, repo_mappings=host_config.get("repo_mappings", ""))
+        component = self.option("deb_component", "main")
+        incoming, matrix_params, _ = _resolve_incoming(self.fqdn, self.login, self.incoming, changes=pkgdata,
+            cli_params=dict(self.cli_params, deb_component=component),
+            repo_mappings=self.host_config.get("repo_mappings", ""))
         log("INFO: Destination base URL is\n    %(url)s", url=urllib2.quote(incoming, safe=":/~;#"))
-        repo_params.update(cli_params)
-        mindepth = int(repo_params.get("mindepth", "0"), 10)
-        overwrite = int(repo_params.get("overwrite", "0"), 10)
         # TODO: Add ability to enter missing password via terminal
         #   auth_handler = PromptingPasswordMgr(login)
 
-        # Special handling for integration test code
-        if "integration-test" in cli_params:
-            import pprint
-            print("upload arguments = ", end="")
-            pprint.pprint(dict((k, v) for k, v in locals().iteritems() if k in (
-                "fqdn", "login", "incoming", "files_to_upload", "debug", "dummy", "progress")))
-            print("host config = ", end="")
-            pprint.pprint(host_config)
-            print("host arguments = ", end="")
-            pprint.pprint(cli_params)
-        else:
-            # TODO: "bintray" REST API support
-            #   POST /packages/:subject/:repo
-            #   POST /packages/:subject/:repo/:package/versions
+        # Packages get their own properties, so Artifactory can index them right away
+        file_params = {}
+        if int(self.option("deb_properties", "0"), 10):
+            distribution = self.option("deb_distribution", pkgdata.get("distribution", "unknown"))
+            for filepath in files_to_upload:
+                if filepath.endswith(".deb") or filepath.endswith(".udeb"):
+                    file_params[filepath] = _deb_matrix_params(matrix_params, filepath, distribution, component)
+                    trace("Properties of %(filename)s: %(params)s",
+                        filename=os.path.basename(filepath), params=file_params[filepath])
+
+        return dict(files=list(files_to_upload), changes_file=changes_file, incoming=incoming,
+            matrix_params=matrix_params, file_params=file_params, known_checksums=_changes_checksums(pkgdata),
+            replicas=[i.prepare(files_to_upload, pkgdata) for i in self.replicas])
+
+    def send(self, job):
+        """ Check the target(s), and upload all files of a `prepare`d changes set.
+
+            Progress is recorded in a journal next to the changes file (unless `journal = 0`),
+            so that a re-run after a failure skips or continues what already arrived.
+        """
+        journal, complete = None, False
+        if job["changes_file"] and int(self.option("journal", "1"), 10) and "simulate" not in self.cli_params:
+            journal = _open_journal(job["changes_file"])
+        try:
+            complete = self.transfer(job, journal)
+        finally:
+            if journal:
+                journal.close(remove=complete)
+
+    def transfer(self, job, journal=None):
+        """ Upload the files of a `prepare`d changes set, and return whether all targets got them.
+
+            With `bundle`, the files go to each target as a single archive, where accepted.
+            With replicas, a failed target gets no further files, and the other targets
+            carry on; depending on `fanout_required`, a failed replica is only reported.
+            If all targets are required, none of them gets the changes after any failure.
+        """
+        # TODO: "bintray" REST API support
+        #   POST /packages/:subject/:repo
+        #   POST /packages/:subject/:repo/:package/versions
+        checksums, failures = {}, {}
+        targets = [(self, job)] + zip(self.replicas, job["replicas"])
+
+        def checksums_of(filepath):
+            "Get checksums of a file, computing them only once."
+            if filepath not in checksums:
+                recorded = journal and journal.checksums(filepath)
+                checksums[filepath] = recorded or _file_checksums(filepath,
+                    job["known_checksums"].get(os.path.basename(filepath)))
+                if journal and not recorded:
+                    journal.add_file(filepath, checksums[filepath])
+            return checksums[filepath]
+
+        plans = {}
+        for session, target_job in targets:
+            try:
+                plans[session] = session.check(target_job, checksums_of, journal)
+            except (dputhelper.DputUploadFatalException, socket.error, urllib2.URLError, EnvironmentError):
+                if session is self or self.option("fanout_required", "all") == "all":
+                    raise
+                failures[session] = sys.exc_info()
+                log("WARN: %(host)s: pre-flight checks failed, skipping it: %(exc)s",
+                    host=session.fqdn, exc=failures[session][1])
+
+        # Upload the files, with the changes last and only after all others succeeded
+        if "simulate" in self.cli_params:
+            for session in [i for i, _ in targets if i in plans]:
+                for filepath in plans[session]["files"]:
+                    log("WOULD upload '%(filename)s'%(host)s", filename=os.path.basename(filepath),
+                        host=" to " + session.fqdn if self.replicas else "")
+            return False
+
+        transferred = dict((session, []) for session, _ in targets)
+
+        def put_to(session, filepath, source):
+            "Upload a single file to one target."
+            plan = plans[session]
+            fileurl, sha256 = _file_url(filepath, plan["incoming"]), checksums_of(filepath)["sha256"]
+            try:
+                if journal:
+                    journal.record(fileurl, sha256, "started")
+                with timed("transfer", file=os.path.basename(filepath), host=session.fqdn) as info:
+                    sent = info["bytes"] = _dav_put(filepath, plan["incoming"],
+                        plan["file_params"].get(filepath, plan["matrix_params"]), session.login,
+                        reporter=session.reporter, pool=session.pool, retry=session.retry,
+                        checksum_deploy=int(session.option("checksum_deploy", "0"), 10),
+                        checksums=checksums_of(filepath), source=source, offset=plan["offsets"].get(filepath, 0))
+                if journal:
+                    journal.record(fileurl, sha256, "done")
+                transferred[session].append((sent, source.size))
+            except (dputhelper.DputUploadFatalException, socket.error, urllib2.URLError, EnvironmentError):
+                failures.setdefault(session, sys.exc_info())
+
+        def put_bundle(session):
+            "Upload all files sharing the same properties to one target in a single archive, if enabled."
+            plan = plans[session]
+            bundled = [i for i in plan["files"] if i not in plan["file_params"]]
+            if len(bundled) < len(plan["files"]):
+                bundled.remove(job["changes_file"])  # has to wait for the files sent one by one
+            if len(bundled) < 2 or not int(session.option("bundle", "0"), 10):
+                return
+            ordered = sorted(bundled, key=lambda i: i == job["changes_file"])  # changes go last
+            try:
+                with timed("transfer", file="bundle", host=session.fqdn) as info:
+                    sent = info["bytes"] = _dav_put_bundle(ordered, plan["incoming"], plan["matrix_params"],
+                        session.login, session.reporter, pool=session.pool)
+            except (dputhelper.DputUploadFatalException, socket.error, urllib2.URLError, EnvironmentError):
+                failures.setdefault(session, sys.exc_info())
+                return
+            if sent is not None:
+                transferred[session].append((sent, sum(os.path.getsize(i) for i in ordered)))
+                plan["files"] = [i for i in plan["files"] if i not in bundled]
+                for filepath in ordered if journal else []:  # unverified, so checked by the next run
+                    journal.record(_file_url(filepath, plan["incoming"]), checksums_of(filepath)["sha256"], "started")
+
+        def put(filepath):
+            "Upload a single file to all targets that still need it, reading it once."
+            receivers = [i for i in plans if i not in failures and filepath in plans[i]["files"]]
+            if not receivers:
+                return
+            checksums_of(filepath)
+            with self.slots:
+                with closing(SharedFile(filepath)) as source:
+                    _run_parallel(lambda session: put_to(session, filepath, source), receivers, len(receivers))
+
+        _run_parallel(put_bundle, [i for i in plans if i not in failures], len(plans))
+        _run_parallel(put, [i for i in job["files"] if i != job["changes_file"]], self.workers)
+        if job["changes_file"] and failures and self.replicas and self.option("fanout_required", "all") == "all":
+            log("WARN: Not uploading '%(filename)s', since not all targets got the other files",
+                filename=os.path.basename(job["changes_file"]))
+        elif job["changes_file"]:
+            put(job["changes_file"])
+
+        for session, _ in targets:
+            log("INFO: %(host)sTransferred %(sent)d bytes for %(total)d bytes of content,"
+                " %(deployed)d file(s) deployed by checksum", host=session.fqdn + ": " if self.replicas else "",
+                sent=sum(i[0] for i in transferred[session]), total=sum(i[1] for i in transferred[session]),
+                deployed=len([i for i in transferred[session] if i[1] and not i[0]]))
+
+        for session, _ in targets:
+            if session in failures and (session is self or self.option("fanout_required", "all") == "all"):
+                exc = failures[session]
+                if self.replicas:
+                    raise dputhelper.DputUploadFatalException("Upload to %s failed: %s" % (session.fqdn, exc[1]))
+                raise exc[0], exc[1], exc[2]
+            elif session in failures:
+                log("WARN: Upload to replica %(host)s failed: %(exc)s", host=session.fqdn, exc=failures[session][1])
+
+        return not failures
+
+    def check(self, job, checksums_of, journal=None):
+        """ Run the pre-flight checks for a `prepare`d changes set,
+            and return the URL, matrix params, and files to upload.
+
+            Files the `journal` says were sent before are checked on the server first;
+            complete ones are skipped, and partial ones continued from their stored size.
+        """
+        files_to_upload, changes_file = job["files"], job["changes_file"]
+        stored, offsets = [], {}
+        with timed("preflight", host=self.fqdn):
+            for filepath in files_to_upload if journal else []:
+                fileurl = _file_url(filepath, job["incoming"])
+                if journal.uploaded(fileurl) != checksums_of(filepath)["sha256"]:
+                    continue
+                size = os.path.getsize(filepath)
+                offset = _stored_size(fileurl, filepath, size, checksums_of(filepath), self.login, pool=self.pool)
+                if offset == size:
+                    log("INFO: Skipping '%(filename)s', uploaded by an earlier run", filename=os.path.basename(filepath))
+                    stored.append(filepath)
+                elif offset:
+                    offsets[filepath] = offset
+
+            identical = _preflight_checks(job["incoming"], files_to_upload, changes_file, self.login, checksums_of,
+                mindepth=int(self.params.get("mindepth", "0"), 10), overwrite=int(self.params.get("overwrite", "0"), 10),
+                skip_identical=int(self.option("skip_identical", "0"), 10), pool=self.pool, stored=stored)
+
+        return dict(incoming=job["incoming"], matrix_params=job["matrix_params"], file_params=job["file_params"],
+            files=[i for i in files_to_upload if i not in identical], offsets=offsets)
+
+    def close(self):
+        """Close all connections, and publish recorded timings."""
+        pools = [self.pool] + [i.pool for i in self.replicas]
+        for pool in pools:
+            pool.close()
+        if sum(i.requests for i in pools):
+            log("INFO: Opened %(opened)d connection(s) for %(requests)d request(s)",
+                opened=sum(i.opened for i in pools), requests=sum(i.requests for i in pools))
+
+        report, statsd = self.option("timing_report", ""), self.option("statsd", "")
+        if timed.recorder and (report or statsd):
+            try:
+                if report:
+                    timed.recorder.write_report(os.path.expanduser(report))
+                    trace("Wrote timings to %(report)s", report=report)
+                if statsd:
+                    timed.recorder.send_statsd(statsd, self.option("statsd_prefix", "dput.webdav"))
+            except (EnvironmentError, ValueError), exc:
+                log("WARN: Publishing upload timings failed: %(exc)s", exc=exc)
 
-            # Check if .changes file already exists
-            if not overwrite and changes_file:
-                try:
-                    _check_url(_file_url(changes_file, incoming), login, [404])
-                except urllib2.HTTPError, exc:
-                    raise dputhelper.DputUploadFatalException("Overwriting existing changes at '%s' not allowed: %s" % (
-                        _file_url(changes_file, incoming), exc))
 
-            # Check for existence of target path with minimal depth
-            if mindepth:
-                try:
-                    _check_url(incoming, login, range(200, 300), mindepth=mindepth)
-                except urllib2.HTTPError, exc:
-                    raise dputhelper.DputUploadFatalException("Required repository path '%s' doesn't exist: %s" % (
-                        exc.filename, exc))
+def upload(fqdn, login, incoming, files_to_upload, # pylint: disable=too-many-arguments
+        debug, dummy, progress=None):
+    """Upload the files via WebDAV."""
+    assert sys.version_info >= (2, 5), "Your snake is a rotting corpse (Python 2.5+ required)"
+    trace.debug = bool(debug)
+    timed.recorder = Timings()
 
-            # Upload the files in the given order
-            for filepath in files_to_upload:
-                if "simulate" in cli_params:
-                    log("WOULD upload '%(filename)s'", filename=os.path.basename(filepath))
-                else:
-                    _dav_put(filepath, incoming, matrix_params, login, progress)
+    try:
+        with timed("config"):
+            host_config, cli_params = _get_config_data(fqdn)
+        session = UploadSession(fqdn, login, incoming, host_config, cli_params, progress)
+        try:
+            session.add_replicas(upload.extended_info.get("config"))
+            job = session.prepare(files_to_upload)
+
+            # Special handling for integration test code
+            if "integration-test" in cli_params:
+                import pprint
+                login, incoming = session.login, job["incoming"]
+                print("upload arguments = ", end="")
+                pprint.pprint(dict((k, v) for k, v in locals().iteritems() if k in (
+                    "fqdn", "login", "incoming", "files_to_upload", "debug", "dummy", "progress")))
+                print("host config = ", end="")
+                pprint.pprint(host_config)
+                print("host arguments = ", end="")
+                pprint.pprint(cli_params)
+            else:
+                session.send(job)
+        finally:
+            session.close()
     except (dputhelper.DputUploadFatalException, socket.error, urllib2.URLError, EnvironmentError), exc:
         log("FATAL: %(exc)s", exc=exc)
         sys.exit(1)
@@ -431,6 +1838,109 @@ def upload(fqdn, login, incoming, files_to_upload, # pylint: disable=too-many-ar
 upload.extended_info = {}
 
 
+def _changes_set(changes_file, pkgdata):
+    """Return the paths of all files belonging to `changes_file`, itself last."""
+    dirname = os.path.dirname(changes_file)
+    return [os.path.join(dirname, line.split()[-1])
+        for line in pkgdata.get("files", "").splitlines() if line.strip()
+    ] + [changes_file]
+
+
+def batch_upload(host, paths, config_files=None, debug=False):
+    """ Upload many changes sets to the configured `host`, in one session.
+
+        `host` can carry arguments like on the `dput` command line ("host:key=val;...").
+        `paths` are changes files, directories containing them, or glob patterns.
+        Configuration, credentials, and connections are set up only once, and
+        the host's `workers` option limits concurrent transfers over all sets.
+        A configured `post_upload_command` runs once after all uploads.
+
+        Returns the number of changes sets that failed.
+    """
+    import glob
+    import ConfigParser
+
+    trace.debug = bool(debug)
+    timed.recorder = Timings()
+    config = ConfigParser.ConfigParser()
+    try:
+        with timed("config"):
+            config_files = config.read(config_files or ["/etc/dput.cf", os.path.expanduser("~/.dput.cf")])
+        trace("Read configuration from %(files)s", files=", ".join(config_files))
+
+        host, host_argument = (host or "").split(':', 1) if ':' in (host or "") else (host, "")
+        if not host and config.has_option("DEFAULT", "default_host_main"):
+            host = config.get("DEFAULT", "default_host_main")
+        if not (host and config.has_option(host, "method") and config.get(host, "method") == "webdav"):
+            raise dputhelper.DputUploadFatalException("No 'webdav' host section '%s' found in %s" % (
+                host or "", ", ".join(config_files) or "configuration"))
+        host_config = dict(config.items(host))
+    except ConfigParser.Error, exc:
+        raise dputhelper.DputUploadFatalException("Bad configuration: %s" % exc)
+    missing = [i for i in ("fqdn", "incoming") if not host_config.get(i)]
+    if missing:
+        raise dputhelper.DputUploadFatalException("Host section '%s' lacks %s" % (
+            host, " and ".join("'%s'" % i for i in missing)))
+    cli_params = _parse_host_argument(host_argument)
+
+    changes_files = []
+    for path in paths:
+        if os.path.isdir(path):
+            changes_files.extend(sorted(glob.glob(os.path.join(path, "*.changes"))))
+        else:
+            changes_files.extend(sorted(glob.glob(path)) or [path])
+
+    session = UploadSession(host_config["fqdn"], host_config.get("login", ""), host_config["incoming"],
+        host_config, cli_params, int(host_config.get("progress_indicator", "0"), 10))
+    session.add_replicas(config)
+    failed = []
+
+    def upload_set(changes_file):
+        "Upload a single changes set."
+        try:
+            pkgdata = _parse_changes(changes_file)
+            session.send(session.prepare(_changes_set(changes_file, pkgdata), pkgdata))
+        except (dputhelper.DputUploadFatalException, socket.error, urllib2.URLError, EnvironmentError), exc:
+            log("FATAL: %(changes)s: %(exc)s", changes=os.path.basename(changes_file), exc=exc)
+            failed.append(changes_file)
+
+    try:
+        _run_parallel(upload_set, changes_files, session.workers)
+    finally:
+        session.close()
+    log("INFO: Uploaded %(done)d of %(total)d changes set(s)",
+        done=len(changes_files) - len(failed), total=len(changes_files))
+
+    if host_config.get("post_upload_command") and len(failed) < len(changes_files) and "simulate" not in cli_params:
+        log("INFO: Running post upload command '%(cmd)s'", cmd=host_config["post_upload_command"])
+        if os.system(host_config["post_upload_command"]):
+            log("WARN: Post upload command failed")
+
+    return len(failed)
+
+
+def _batch_main(argv):
+    """Command line interface for batch uploads."""
+    import optparse
+
+    parser = optparse.OptionParser(usage="%prog batch [options] [host[:args]] <changes file|directory|glob>...")
+    parser.add_option("-c", "--config", action="append", help="read this configuration file (repeatable)")
+    parser.add_option("-d", "--debug", action="store_true", default=False, help="show debug traces")
+    opts, args = parser.parse_args(argv)
+
+    host = None
+    if args and not os.path.exists(args[0]) and not args[0].endswith(".changes"):
+        host = args.pop(0)
+    if not args:
+        parser.error("No changes files given")
+
+    try:
+        return batch_upload(host, args, config_files=opts.config, debug=opts.debug)
+    except dputhelper.DputUploadFatalException, exc:
+        log("FATAL: %(exc)s", exc=exc)
+        return 1
+
+
 #
 # Unit Tests
 #
@@ -496,6 +2006,11 @@ class WebdavTest(unittest.TestCase): # pylint: disable=too-many-public-methods
         self.assertEquals(result, "http://repo.example.com:80/a/b/")
         self.assertEquals(matrix_params, "foo=bar;bar=foo")
 
+        # Debian pool layout
+        result, _, _ = _resolve_incoming("repo.example.com:80", "", py25_format(
+            "/pool/{deb_component}/{pool_prefix}/{source}/"), changes=dict(source="libfoo"))
+        self.assertEquals(result, "http://repo.example.com:80/pool/main/libf/libfoo/")
+
         # Unsupported URL scheme
         self.assertRaises(dputhelper.DputUploadFatalException, _resolve_incoming, "", "", "file:///incoming/")
 
@@ -503,8 +2018,457 @@ class WebdavTest(unittest.TestCase): # pylint: disable=too-many-public-methods
         self.assertRaises(dputhelper.DputUploadFatalException, _resolve_incoming,
             "", "", py25_format("http://example.com/incoming/{not_defined_ever}/"))
 
+    @staticmethod
+    def _write_deb(filepath, control):
+        """Write a minimal Debian package with the `control` file's text to `filepath`."""
+        import tarfile
+        from cStringIO import StringIO
+
+        control_tar = StringIO()
+        with closing(tarfile.open(fileobj=control_tar, mode="w:gz")) as archive:
+            info = tarfile.TarInfo("./control")
+            info.size = len(control)
+            archive.addfile(info, StringIO(control))
+        members = [("debian-binary", "2.0\n"), ("control.tar.gz", control_tar.getvalue())]
+
+        with closing(io.open(filepath, 'wb')) as handle:
+            handle.write("!<arch>\n")
+            for name, data in members:
+                handle.write("%-16s%-12d%-6d%-6d%-8s%-10d`\n" % (name, 0, 0, 0, "100644", len(data)))
+                handle.write(data + "\n" * (len(data) % 2))
+
+    @staticmethod
+    def _stand_in():
+        """Start the stand-in server of "benchmark.py" in a thread, and return it."""
+        import optparse
+        import benchmark
+
+        server = benchmark.StandInServer(optparse.Values(dict(
+            port=0, seed=0, tls=False, latency=0.0, bandwidth=0.0, error_rate=0.0)))
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return server
+
+    @staticmethod
+    def _upload(server, files, **options):
+        """Upload `files` to the stand-in `server` with the given host `options`, and return whether that worked."""
+        import ConfigParser
+        from cStringIO import StringIO
+
+        config = ConfigParser.ConfigParser()
+        config.add_section("test")
+        for key, val in options.items():
+            config.set("test", key, str(val))
+        extended_info, upload.extended_info = upload.extended_info, dict(config=config, host="test")
+        stdout, sys.stdout = sys.stdout, StringIO()
+        try:
+            upload("127.0.0.1:%d" % server.server_address[1], "test:test",
+                "http://{fqdn}/artifactory/debian-local/{source}/{upstream}/#overwrite=1", files, 0, 0, progress=0)
+        except SystemExit:
+            return False
+        finally:
+            sys.stdout = stdout
+            upload.extended_info = extended_info
+        return True
+
+    def test_deb_matrix_params(self):
+        """Test per-package properties, read from the control data."""
+        import shutil
+        import tempfile
+
+        tempdir = tempfile.mkdtemp()
+        try:
+            filepath = os.path.join(tempdir, "foo_1.0_amd64.deb")
+            self._write_deb(filepath, "Package: foo\nArchitecture: amd64\n")
+
+            self.assertEquals(_deb_control(filepath)["package"], "foo")
+            self.assertEquals(_deb_matrix_params("x=1;deb.architecture=all;deb.architecture=amd64", filepath,
+                "unstable", "main"), "x=1;deb.distribution=unstable;deb.component=main;deb.architecture=amd64")
+            self.assertEquals(_deb_matrix_params("deb.component=local;deb.distribution=snapshots", filepath,
+                "unstable", "main"), "deb.distribution=snapshots;deb.component=local;deb.architecture=amd64")
+            self.assertRaises(dputhelper.DputUploadFatalException, _deb_control, __file__)
+        finally:
+            shutil.rmtree(tempdir)
+
+    def test_bundle_with_deb_properties(self):
+        """Test that the changes go last, when only some files are bundled."""
+        import shutil
+        import tempfile
+
+        tempdir = tempfile.mkdtemp()
+        server = self._stand_in()
+        try:
+            files = [os.path.join(tempdir, i) for i in ("foo_1.0.dsc", "foo_1.0.tar.gz", "foo_1.0_all.deb")]
+            for filepath in files[:2]:
+                with closing(io.open(filepath, 'wb')) as handle:
+                    handle.write(os.urandom(1000))
+            self._write_deb(files[2], "Package: foo\nArchitecture: all\n")
+            files.append(os.path.join(tempdir, "foo_1.0_amd64.changes"))
+            with closing(io.open(files[-1], 'wb')) as handle:
+                handle.write("Source: foo\nVersion: 1.0-1\nDistribution: unstable\nArchitecture: source all\n")
+
+            self.assertTrue(self._upload(server, files, bundle=1, deb_properties=1))
+            puts = [path for method, path in server.history if method == "PUT"]
+            self.assertEquals(len(puts), 3)
+            self.assertTrue(puts[0].endswith(".tar"))
+            self.assertTrue(puts[1].endswith("/foo_1.0_all.deb;deb.distribution=unstable;deb.component=main;"
+                "deb.architecture=all"))
+            self.assertTrue(puts[2].endswith("/foo_1.0_amd64.changes"))
+            self.assertEquals(sorted(server.files), ["/artifactory/debian-local/foo/1.0/" + os.path.basename(i)
+                for i in sorted(files)])
+        finally:
+            server.shutdown()
+            server.server_close()
+            shutil.rmtree(tempdir)
+
+    def test_batch_config(self):
+        """Test that incomplete host configurations are reported as fatal."""
+        import tempfile
+
+        with closing(tempfile.NamedTemporaryFile(suffix=".cf")) as handle:
+            handle.write("[DEFAULT]\nlogin = *\n[nomethod]\nfqdn = example.com\n"
+                "[nofqdn]\nmethod = webdav\nincoming = http://{fqdn}/\n[bad]\nmethod = webdav\nlogin = %(oops)s\n")
+            handle.flush()
+            for host, message in ((None, "No 'webdav' host section ''"), ("nomethod", "No 'webdav' host section"),
+                    ("nofqdn", "lacks 'fqdn'"), ("bad", "Bad configuration")):
+                try:
+                    batch_upload(host, [], config_files=[handle.name])
+                except dputhelper.DputUploadFatalException, exc:
+                    self.assertTrue(message in str(exc), "%r not in %r" % (message, str(exc)))
+                else:
+                    self.fail("No error for host %r" % host)
+
+    def test_changes_checksums(self):
+        """Test reading file checksums from changes."""
+        pkgdata = _parse_changes('\n'.join([
+            "Source: dput-webdav-checksum-test",
+            "Checksums-Sha1: ",
+            " 2aae6c35c94fcfb415dbe95f408b9ce91ee846ed 11 foo_1.0_all.deb",
+            "Checksums-Sha256: ",
+            " b94d27b9934d3e08a52e52d7da7dabfac484efe37a5380ee9088f7ace2efcde9 11 foo_1.0_all.deb",
+            "Files: ",
+            " 5eb63bbbe01eeed093cb22bb8f5acdc3 11 devel extra foo_1.0_all.deb",
+            " 5eb63bbbe01eeed093cb22bb8f5acdc3 12 devel extra foo_1.0.dsc",
+            '']))
+        result = _changes_checksums(pkgdata)
+        self.assertEquals(sorted(result), ["foo_1.0.dsc", "foo_1.0_all.deb"])
+        self.assertEquals(result["foo_1.0_all.deb"]["size"], 11)
+        self.assertEquals(result["foo_1.0_all.deb"]["sha1"], "2aae6c35c94fcfb415dbe95f408b9ce91ee846ed")
+        self.assertEquals(result["foo_1.0.dsc"], dict(size=12, md5="5eb63bbbe01eeed093cb22bb8f5acdc3"))
+
+    def test_changes_set(self):
+        """Test finding the files of a changes set."""
+        pkgdata = dict(files="\n".join([
+            "5eb63bbbe01eeed093cb22bb8f5acdc3 12 devel extra foo_1.0.dsc",
+            " 5eb63bbbe01eeed093cb22bb8f5acdc3 11 devel extra foo_1.0_all.deb",
+        ]))
+        self.assertEquals(_changes_set("build/foo_1.0_all.changes", pkgdata),
+            ["build/foo_1.0.dsc", "build/foo_1.0_all.deb", "build/foo_1.0_all.changes"])
+        self.assertEquals(_changes_set("foo.changes", {}), ["foo.changes"])
+
+    def test_file_checksums(self):
+        """Test file hashing."""
+        import tempfile
+
+        handle, filepath = tempfile.mkstemp(suffix=".deb")
+        try:
+            os.write(handle, "hello world" * 100000)
+            os.close(handle)
+            data = "hello world" * 100000
+            expected = dict((algo, getattr(hashlib, algo)(data).hexdigest()) for algo in CHECKSUM_ALGOS)
+
+            self.assertEquals(_file_checksums(filepath), expected)
+            self.assertEquals(_file_checksums(filepath, dict(size=len(data), md5="0" * 32))["md5"], "0" * 32)
+            self.assertEquals(_file_checksums(filepath, dict(size=1, md5="0" * 32)), expected)
+        finally:
+            os.remove(filepath)
+
+    def test_connection_dropped(self):
+        """Test detection of closed keep-alive connections."""
+        conn = httplib.HTTPConnection("localhost")
+        self.assertTrue(_connection_dropped(conn))
+
+        conn.sock, peer = socket.socketpair()
+        try:
+            self.assertFalse(_connection_dropped(conn))
+            peer.close()
+            self.assertTrue(_connection_dropped(conn))
+        finally:
+            conn.sock.close()
+
+    def test_retry_backoff(self):
+        """Test retry delays."""
+        retry = RetryPolicy(delay=2.0, max_delay=10.0)
+        for attempt, limit in ((1, 2.0), (2, 4.0), (3, 8.0), (4, 10.0), (10, 10.0)):
+            delay = retry.backoff(attempt)
+            self.assertTrue(limit / 2 <= delay <= limit, "%r not in [%r, %r]" % (delay, limit / 2, limit))
+
+        self.assertEquals(retry.backoff(1, "120"), 120.0)
+        self.assertEquals(retry.backoff(1, "Wed, 21 Oct 2015 07:28:00 GMT"), 0.0)
+        self.assertTrue(retry.backoff(1, "soon") <= 2.0)
+
+    def test_retry_and_resume(self):
+        """Test retries of failed uploads against a stand-in server, continuing them where supported."""
+        import tempfile
+        from cStringIO import StringIO
+
+        server = self._stand_in()
+        url = "http://127.0.0.1:%d/artifactory/debian-local/foo/" % server.server_address[1]
+        retry = RetryPolicy(retries=2, delay=30.0, max_delay=30.0, resume_threshold=0)  # Retry-After says 0
+        stdout, sys.stdout = sys.stdout, StringIO()
+        try:
+            with closing(tempfile.NamedTemporaryFile(suffix=".deb")) as handle:
+                handle.write(os.urandom(300000))
+                handle.flush()
+                path = "/artifactory/debian-local/foo/" + os.path.basename(handle.name)
+                checksums = _file_checksums(handle.name)
+
+                def put(faults, range_status=None, ignore_ranges=False):
+                    "Upload with the given server behaviour, returning the transferred bytes and PUT count."
+                    server.reset()
+                    server.faults[:] = faults
+                    server.range_status, server.ignore_ranges = range_status, ignore_ranges
+                    started = time.time()
+                    sent = _dav_put(handle.name, url, "", "test:test", retry=retry, pool=ConnectionPool())
+                    self.assertTrue(time.time() - started < 10)
+                    self.assertEquals(server.files[path]["sha1"], checksums["sha1"])
+                    return sent, len([i for i in server.history if i[0] == "PUT"])
+
+                self.assertEquals(put([(503, 0)]), (600000, 2))
+                self.assertEquals(put([(503, 100000), (502, 200000)]), (300000 + 200000 + 100000, 3))
+                for status in (400, 405, 416):
+                    self.assertEquals(put([(503, 100000)], range_status=status), (300000 + 200000 + 300000, 3))
+                self.assertEquals(put([(503, 100000)], ignore_ranges=True), (300000 + 200000 + 300000, 3))
+                server.verify_checksums = False  # the broken copy is only detected by checking it afterwards
+                try:
+                    self.assertEquals(put([(503, 100000)], ignore_ranges=True), (300000 + 200000 + 300000, 3))
+                finally:
+                    server.verify_checksums = True
+
+                server.reset()
+                server.faults[:] = [(503, 0)] * 3
+                self.assertRaises(urllib2.URLError, _dav_put, handle.name, url, "", "test:test", retry=retry)
+        finally:
+            sys.stdout = stdout
+            server.shutdown()
+            server.server_close()
+
+    def test_parse_multistatus(self):
+        """Test parsing of collection listings."""
+        body = """<?xml version="1.0" encoding="UTF-8"?>
+            <D:multistatus xmlns:D="DAV:">
+              <D:response><D:href>/art/repo/foo/</D:href>
+                <D:propstat><D:prop><D:resourcetype><D:collection/></D:resourcetype></D:prop>
+                  <D:status>HTTP/1.1 200 OK</D:status></D:propstat></D:response>
+              <D:response><D:href>http://repo.example.com/art/repo/foo/foo%2B1_1.0.dsc</D:href>
+                <D:propstat><D:prop><D:resourcetype/><D:getcontentlength>42</D:getcontentlength>
+                  <D:getetag>"5EB63BBBE01EEED093CB22BB8F5ACDC3"</D:getetag></D:prop>
+                  <D:status>HTTP/1.1 200 OK</D:status></D:propstat></D:response>
+              <D:response><D:href>/art/repo/foo/sub/</D:href>
+                <D:propstat><D:prop><D:resourcetype><D:collection/></D:resourcetype></D:prop>
+                  <D:status>HTTP/1.1 200 OK</D:status></D:propstat>
+                <D:propstat><D:prop><D:getetag/></D:prop>
+                  <D:status>HTTP/1.1 404 Not Found</D:status></D:propstat></D:response>
+            </D:multistatus>"""
+        result = _parse_multistatus(body, "http://repo.example.com/art/repo/foo/")
+        self.assertEquals(result, {
+            "foo+1_1.0.dsc": dict(size=42, etag="5eb63bbbe01eeed093cb22bb8f5acdc3"),
+            "sub": None,
+        })
+        self.assertRaises(urllib2.URLError, _parse_multistatus, "<D:multi", "http://repo.example.com/")
+
+    def test_timings(self):
+        """Test recording of timed phases."""
+        saved, timed.recorder = timed.recorder, Timings()
+        try:
+            with timed("hashing", file="a.deb") as info:
+                info["bytes"] = 1000
+            with timed("hashing", file="b.deb") as info:
+                info["bytes"] = 2000
+            try:
+                with timed("transfer", file="a.deb"):
+                    raise IOError("failed")
+            except IOError:
+                pass
+            events = timed.recorder.events
+            summary = timed.recorder.summary()
+        finally:
+            timed.recorder = saved
+
+        self.assertEquals([(i["phase"], i.get("bytes"), i.get("failed")) for i in events],
+            [("hashing", 1000, None), ("hashing", 2000, None), ("transfer", None, True)])
+        self.assertEquals(summary["hashing"]["count"], 2)
+        self.assertEquals(summary["hashing"]["bytes"], 3000)
+        self.assertEquals(summary["transfer"]["count"], 1)
+
+    def test_next_chunk_size(self):
+        """Test adapting the send block size to the throughput."""
+        self.assertEquals(_next_chunk_size(CHUNK_SIZE, CHUNK_SIZE, 0), 2 * CHUNK_SIZE)
+        self.assertEquals(_next_chunk_size(MAX_CHUNK_SIZE, MAX_CHUNK_SIZE, 0), MAX_CHUNK_SIZE)
+        # 100 MB/s -> 5 MB per 50 msec
+        self.assertEquals(_next_chunk_size(CHUNK_SIZE, CHUNK_SIZE, CHUNK_SIZE / 1E8), 2 * CHUNK_SIZE)
+        self.assertEquals(_next_chunk_size(1024 * 1024, 1024 * 1024, 1024 * 1024 / 1E8), 2 * 1024 * 1024)
+        # 1 MB/s -> 50 KB per 50 msec
+        self.assertEquals(_next_chunk_size(1024 * 1024, 1024 * 1024, 1.0), 64 * 1024)
+        # a short last block doesn't grow the size
+        self.assertEquals(_next_chunk_size(CHUNK_SIZE, 100, 1E-6), CHUNK_SIZE)
+
+    def test_send_file(self):
+        """Test sending a file via sendfile() and by copying, with progress."""
+        import tempfile
+
+        class Connection(object):
+            "Fake connection with a real socket."
+            debuglevel = 0
+            def __init__(self, sock):
+                self.sock = sock
+            def send(self, data):
+                "Send `data`."
+                self.sock.sendall(data)
+
+        data = os.urandom(3 * CHUNK_SIZE + 42)
+        with closing(tempfile.NamedTemporaryFile()) as handle:
+            handle.write(data)
+            handle.flush()
+            for zerocopy in (True, False):
+                sendfile = _sendfile.__dict__.pop("func", None)
+                if not zerocopy:
+                    _sendfile.func = None
+                sender, receiver = socket.socketpair()
+                sent = []
+                try:
+                    with closing(SharedFile(handle.name)) as source:
+                        _send_file(Connection(sender), source, 10, len(data), progress=sent.append)
+                    sender.shutdown(socket.SHUT_WR)
+                    received = "".join(iter(lambda: receiver.recv(65536), ""))
+                finally:
+                    sender.close()
+                    receiver.close()
+                    _sendfile.func = sendfile
+                self.assertEquals(received, data[10:])
+                self.assertEquals(sum(sent), len(data) - 10)
+
+    def test_run_parallel(self):
+        """Test concurrent calls and error propagation."""
+        for workers in (1, 4):
+            done = []
+            _run_parallel(done.append, range(10), workers)
+            self.assertEquals(sorted(done), range(10))
+
+            def fail(item):
+                "Fail for one item."
+                if item == 3:
+                    raise ValueError(item)
+            self.assertRaises(ValueError, _run_parallel, fail, range(10), workers)
+
+    def test_send_bundle(self):
+        """Test streaming files as a tar archive of the announced size."""
+        import shutil
+        import tarfile
+        import tempfile
+        from cStringIO import StringIO
+
+        class Connection(object):
+            "Fake connection collecting the sent data."
+            debuglevel = 0
+            def __init__(self):
+                self.data = StringIO()
+            def send(self, data):
+                "Send `data`."
+                self.data.write(str(data))
+
+        tempdir = tempfile.mkdtemp()
+        try:
+            filepaths = []
+            for name, size in (("foo.dsc", 0), ("foo_all.deb", 3 * CHUNK_SIZE + 1), ("foo.changes", 512)):
+                filepaths.append(os.path.join(tempdir, name))
+                with closing(io.open(filepaths[-1], 'wb')) as handle:
+                    handle.write(os.urandom(size))
+
+            members, size = _bundle_layout(filepaths)
+            conn, sent = Connection(), []
+            sendfile, _sendfile.func = _sendfile.__dict__.pop("func", None), None
+            try:
+                _send_bundle(conn, members, progress=sent.append)
+            finally:
+                _sendfile.func = sendfile
+            self.assertEquals(len(conn.data.getvalue()), size)
+            self.assertEquals(sum(sent), size - 2 * tarfile.BLOCKSIZE)
+
+            conn.data.seek(0)
+            with closing(tarfile.open(fileobj=conn.data)) as archive:
+                self.assertEquals(archive.getnames(), [os.path.basename(i) for i in filepaths])
+                for filepath in filepaths:
+                    self.assertEquals(archive.extractfile(os.path.basename(filepath)).read(), open(filepath, 'rb').read())
+        finally:
+            shutil.rmtree(tempdir)
+
+    def test_upload_journal(self):
+        """Test recording checksums and uploads, across runs."""
+        import shutil
+        import tempfile
+
+        tempdir = tempfile.mkdtemp()
+        try:
+            filepath = os.path.join(tempdir, "foo_1.0_all.deb")
+            with closing(io.open(filepath, 'wb')) as handle:
+                handle.write("foo")
+            journal = _open_journal(os.path.join(tempdir, "foo_1.0_amd64.changes"))
+            self.assertEquals(journal.checksums(filepath), None)
+            journal.add_file(filepath, _file_checksums(filepath))
+            journal.close()
+            self.assertEquals(os.listdir(tempdir), ["foo_1.0_all.deb"])  # nothing uploaded
+
+            journal = _open_journal(os.path.join(tempdir, "foo_1.0_amd64.changes"))
+            journal.add_file(filepath, _file_checksums(filepath))
+            journal.record("http://example.com/foo_1.0_all.deb", "0" * 64, "started")
+            journal.close()
+
+            journal = _open_journal(os.path.join(tempdir, "foo_1.0_amd64.changes"))
+            self.assertEquals(journal.checksums(filepath)["sha1"], hashlib.sha1("foo").hexdigest())
+            self.assertEquals(journal.uploaded("http://example.com/foo_1.0_all.deb"), "0" * 64)
+            self.assertEquals(journal.uploaded("http://example.com/foo_1.0.dsc"), None)
+
+            os.utime(filepath, (0, 0))
+            self.assertEquals(journal.checksums(filepath), None)
+            journal.db.close()  # make further writes fail
+            journal.record("http://example.com/foo_1.0.dsc", "0" * 64, "started")
+            self.assertTrue(journal.failed)
+            self.assertEquals(journal.uploaded("http://example.com/foo_1.0_all.deb"), None)
+            journal.close(remove=True)
+            self.assertEquals(os.listdir(tempdir), ["foo_1.0_all.deb"])
+        finally:
+            shutil.rmtree(tempdir)
+
+    def test_shared_file(self):
+        """Test reading a file from several targets at once, with labelled progress."""
+        import tempfile
+        from cStringIO import StringIO
+
+        with closing(tempfile.NamedTemporaryFile()) as handle:
+            handle.write("0123456789")
+            handle.flush()
+            with closing(SharedFile(handle.name)) as source:
+                self.assertEquals(source.size, 10)
+                chunks = {}
+                _run_parallel(lambda i: chunks.setdefault(i, str(source.read_at(i, 3))), range(10), 4)
+                self.assertEquals([chunks[i] for i in (0, 8, 9)], ["012", "89", "9"])
+
+        stream = StringIO()
+        reporter = ParallelUploadProgress(None, stream)
+        for name in ("primary", "replica"):
+            progress = _TargetProgress(reporter, name)
+            progress.start("/tmp/foo.deb")
+            progress.finish("/tmp/foo.deb", "done")
+        self.assertEquals(stream.getvalue(),
+            "  Uploading foo.deb @ primary: done.\n  Uploading foo.deb @ replica: done.\n")
+
 
 if __name__ == "__main__":
+    if sys.argv[1:2] == ["batch"]:
+        sys.exit(1 if _batch_main(sys.argv[2:]) else 0)
+
     import mock
 
     print("artifactory webdav plugin tests")
@@ -17,6 +17,8 @@ repo_url="${repo_url%/}/$repo_name/"
 repo_mount="/mnt/artifactory-$repo_name"
 davfs_options="auto,_netdev,noexec,ro,uid=davfs2,gid=users,file_mode=440,dir_mode=550"
 confdir="$(pwd)" # $(cd $(dirname "$0") && pwd)
+cachedir="${DEB_INDEX_CACHE:-$(pwd)/cache}" # package caches, kept by 'clean'
+engine="${DEB_INDEX_ENGINE:-debindex}" # or "apt-ftparchive" for a full rescan via davfs2
 
 
 fail() { # fail with error message and exit code 1
@@ -25,17 +27,6 @@ fail() { # fail with error message and exit code 1
 }
 
 
-repo_credentials() { # get credentials for uploading to Artifactory
-    if test -n "$ARTIFACTORY_CREDENTIALS"; then
-        echo "$ARTIFACTORY_CREDENTIALS"
-    elif test -f ~/.artifactory.credentials; then
-        cat ~/.artifactory.credentials
-    else
-        fail "Artifactory deployment credentials are missing"
-    fi
-}
-
-
 init() { # initialization checks
     test -n "$repo_url" || fail "You MUST provide the Artifactory repository URL as the 2nd parameter," \
         "or in the ARTIFACTORY_URL environment variable"
@@ -78,8 +69,32 @@ repolabel() { # extract repository name from configuration file path
 }
 
 
+prepare() { # create working directories, and move caches of older versions to 'cachedir'
+    mkdir -p tmp work "$cachedir"; touch {tmp,work}/.deb-index
+    for cache in tmp/*.db; do
+        test ! -f "$cache" -o -e "$cachedir/$(basename "$cache")" || mv "$cache" "$cachedir/"
+    done
+}
+
+
 reindex() { # create index files in current working directory
-    mkdir -p tmp work; touch {tmp,work}/.deb-index
+    prepare
+
+    case "$engine" in
+        debindex)       reindex_incremental ;;
+        apt-ftparchive) reindex_full ;;
+        *)              fail "Unknown indexing engine '$engine'" ;;
+    esac
+}
+
+
+reindex_incremental() { # index new and changed packages only, using the state kept in 'cachedir'
+    python "$(dirname "$0")/debindex.py" reindex -c "$confdir" -w work -s "$cachedir/debindex.db" \
+        ${DEB_INDEX_DEBUG:+--debug} "$repo_url"
+}
+
+
+reindex_full() { # rescan the mounted repository with apt-ftparchive
 
     # Create writable symlinked tree of read-only repository for indexing
     for repo_conf in $confdir/repo-*.conf; do
@@ -98,8 +113,17 @@ reindex() { # create index files in current working directory
         popd >/dev/null
     done
 
-    # Update index databases
-    ( cd work && apt-ftparchive generate $confdir/apt-ftparchive.conf )
+    # Update index databases, one process per repository (each with its own cache)
+    local pids="" pid
+    for repo_conf in $confdir/repo-*.conf; do
+        repo=$(repolabel "$repo_conf")
+        generate_repo "$repo" >"tmp/generate-${repo}.log" 2>&1 &
+        pids="$pids $!"
+    done
+    for pid in $pids; do
+        wait $pid || { cat tmp/generate-*.log >&2; fail "apt-ftparchive generate failed"; }
+    done
+    cat tmp/generate-*.log
 
     # Generate the APT index
     for repo_conf in $confdir/repo-*.conf; do
@@ -119,27 +143,37 @@ reindex() { # create index files in current working directory
 }
 
 
+generate_repo() { # run apt-ftparchive for a single 'BinDirectory', using the persistent cache
+    local repo="$1" other
+
+    # Include the main configuration, minus the sections of all other repositories
+    {
+        echo "#include \"$confdir/apt-ftparchive.conf\";"
+        echo "Dir::CacheDir \"$cachedir/\";"
+        for other in $confdir/repo-*.conf; do
+            other=$(repo_conf="$other" repolabel)
+            test "$other" = "$repo" || echo "#clear BinDirectory::$other;"
+        done
+    } >"tmp/apt-ftparchive-${repo}.conf"
+
+    ( cd work && apt-ftparchive generate "../tmp/apt-ftparchive-${repo}.conf" )
+}
+
+
 upload() { # upload index files created by 'reindex'
     test -d work || fail "Nothing to upload in $(pwd)"
 
-    log=$(pwd)/work/upload.log
-    date >"$log"
-    echo >>"$log"
+    python "$(dirname "$0")/debindex.py" publish -c "$confdir" -w work \
+        ${DEB_INDEX_DEBUG:+--debug} "$repo_url"
+}
 
-    for repo_conf in $confdir/repo-*.conf; do
-        repo=$(repolabel "$repo_conf")
-        pushd work >/dev/null
-        for file in $repo/*; do
-            test -f $file || continue # skip the symlinks
-            test -s $file || fail "'$file' is empty"
-            echo "PUTting $repo_url$file"
-            echo "$repo_url$file" >>"$log"
-            curl -X PUT -u "$(repo_credentials)" -f --data-binary @$file $repo_url$file >>"$log"
-            echo >>"$log"
-            echo >>"$log"
-        done
-        popd >/dev/null
-    done
+
+serve() { # refresh repositories on upload notifications, until stopped
+    prepare
+
+    exec python "$(dirname "$0")/debindex.py" serve -c "$confdir" -w work -s "$cachedir/debindex.db" \
+        -l "${DEB_INDEX_LISTEN:-127.0.0.1:8090}" ${DEB_INDEX_DEBOUNCE:+--debounce $DEB_INDEX_DEBOUNCE} \
+        ${DEB_INDEX_DEBUG:+--debug} "$repo_url"
 }
 
 
@@ -150,14 +184,22 @@ clean() { # clean up temporary files owned by us
 }
 
 
+purge() { # clean up, and also drop the package caches, forcing a complete re-index
+    clean
+    rm -f "$cachedir"/*.db
+}
+
+
 case "$action" in
     setup)      init; setup ;;
     create)     init; reindex ;;
     upload)     init; upload ;;
     refresh)    init; reindex; echo; upload ;;
+    serve)      init; serve ;;
     clean)      clean ;;
+    purge)      purge ;;
     *)
-        echo >&2 "usage: $(basename $0) refresh|setup [<repo-url>]"
+        echo >&2 "usage: $(basename $0) refresh|serve|setup [<repo-url>]"
         exit 1
         ;;
 esac
@@ -0,0 +1,1393 @@
+# -*- coding: utf-8 -*-
+# pylint: disable=locally-disabled, bad-continuation
+""" Incremental indexing of Debian repositories stored in Artifactory.
+
+    Lists each repository over HTTP, remembers already indexed packages in a
+    state database, and only reads the control data of new or changed files.
+    The index files are then written from that state, following the settings
+    in "apt-ftparchive.conf" and "repo-*.conf".
+
+    Called by "deb-index.sh reindex", see there for the environment it expects.
+    With "serve", it runs as a service that refreshes repositories on upload notifications.
+"""
+from __future__ import with_statement, print_function
+
+import io
+import os
+import re
+import sys
+import bz2
+import glob
+import gzip
+import json
+import time
+import urllib
+import base64
+import fnmatch
+import socket
+import sqlite3
+import hashlib
+import httplib
+import tarfile
+import urllib2
+import urlparse
+import optparse
+import threading
+import BaseHTTPServer
+import unittest
+import subprocess
+from cStringIO import StringIO
+from contextlib import closing
+from multiprocessing import cpu_count
+from xml.etree import ElementTree
+from xml.parsers import expat
+
+
+# Block size for streaming downloads
+CHUNK_SIZE = 64 * 1024
+
+# Initial amount of a package to fetch for reading its control data
+CONTROL_PREFETCH = 64 * 1024
+
+# Checksums stored by Artifactory, and needed for indexes
+CHECKSUM_ALGOS = ("md5", "sha1", "sha256")
+
+# Compression methods for index files, with their file extension and command
+# (gzip and bzip2 at their default levels, as used for "Sources" by the shell pipeline)
+COMPRESSORS = dict(
+    gzip=(".gz", ["gzip", "-6", "-n"]),
+    bzip2=(".bz2", ["bzip2", "-9"]),
+    xz=(".xz", ["xz", "-6"]),
+    zstd=(".zst", ["zstd", "-19", "-q"]),
+)
+
+# Field order of index stanzas, as used by apt-ftparchive
+PACKAGES_ORDER = ("Package", "Essential", "Status", "Priority", "Section", "Installed-Size", "Maintainer",
+    "Original-Maintainer", "Architecture", "Source", "Version", "Revision", "Config-Version", "Replaces",
+    "Provides", "Depends", "Pre-Depends", "Recommends", "Suggests", "Conflicts", "Breaks", "Conffiles",
+    "Filename", "Size", "MD5sum", "SHA1", "SHA256", "SHA512", "MSDOS-Filename", "Description")
+SOURCES_ORDER = ("Package", "Source", "Binary", "Version", "Priority", "Section", "Maintainer",
+    "Original-Maintainer", "Build-Depends", "Build-Depends-Indep", "Build-Conflicts", "Build-Conflicts-Indep",
+    "Architecture", "Standards-Version", "Format", "Directory", "Files")
+RELEASE_FIELDS = ("Origin", "Label", "Suite", "Version", "Codename", "Date", "Valid-Until", "NotAutomatic",
+    "ButAutomaticUpgrades", "Architectures", "Components", "Description")
+
+# Files of a repository listed in its "Release" file (apt-ftparchive defaults)
+RELEASE_PATTERNS = ("Packages", "Packages.*", "Sources", "Sources.*", "Contents-*", "Index", "md5sum.txt")
+
+# Release files of a repository, in the order they're published
+RELEASE_NAMES = ("Release", "Release.gpg", "InRelease")
+
+# Checksum fields of a "Release" file, and their digest algorithm
+RELEASE_CHECKSUMS = (("MD5Sum", "md5"), ("SHA1", "sha1"), ("SHA256", "sha256"))
+
+# Checksum fields of source packages, and their digest algorithm
+SOURCE_CHECKSUMS = (("Files", "md5"), ("Checksums-Sha1", "sha1"), ("Checksums-Sha256", "sha256"))
+
+
+def trace(msg, **kwargs):
+    """Emit log traces in debug mode."""
+    if trace.debug:
+        print("D: debindex: " + (msg % kwargs))
+trace.debug = False
+
+
+def log(msg, **kwargs):
+    """Emit log message to stderr."""
+    sys.stdout.flush()
+    sys.stderr.write("debindex: " + (msg % kwargs) + "\n")
+    sys.stderr.flush()
+
+
+class IndexingError(Exception):
+    """Fatal problem during indexing."""
+
+
+#
+# Configuration
+#
+
+def parse_apt_conf(text):
+    """ Parse apt's configuration syntax into a list of ("Outer::Inner", value) pairs.
+
+        Named blocks like `BinDirectory "noplat" { … }` become "BinDirectory::noplat::…" keys.
+    """
+    text = re.sub(r"(?m)^\s*#.*$|//.*$", "", text)
+    tokens = re.findall(r'"[^"]*"|[{};]|[^\s{};"]+', text)
+    result, scope, words = [], [], []
+    for token in tokens:
+        if token == '{':
+            scope.append("::".join(words))
+            words = []
+        elif token == '}':
+            if words:
+                raise IndexingError("Missing ';' before '}' in apt configuration")
+            scope.pop()
+        elif token == ';':
+            if words:
+                key = "::".join(scope + [words[0]])
+                result.append((key, " ".join(words[1:])))
+            words = []
+        else:
+            words.append(token.strip('"'))
+
+    if scope or words:
+        raise IndexingError("Unbalanced braces or missing ';' in apt configuration")
+    return result
+
+
+class ArchiveConfig(object):
+    """Repository definitions, read from "apt-ftparchive.conf" and the "repo-*.conf" files in `confdir`."""
+
+    def __init__(self, confdir):
+        self.confdir = confdir
+        with closing(io.open(os.path.join(confdir, "apt-ftparchive.conf"), 'r', encoding='utf-8')) as handle:
+            self.settings = parse_apt_conf(handle.read())
+
+        self.repos = []
+        for repo_conf in sorted(glob.glob(os.path.join(confdir, "repo-*.conf"))):
+            name = os.path.splitext(os.path.basename(repo_conf))[0][len("repo-"):]
+            with closing(io.open(repo_conf, 'r', encoding='utf-8')) as handle:
+                release = dict((key.split("::")[-1], val) for key, val in parse_apt_conf(handle.read())
+                    if key.startswith("APT::FTPArchive::Release::"))
+            self.repos.append(dict(name=name, release=release, confdir=confdir, **self.bin_directory(name)))
+
+    def get(self, key, default=None):
+        """Return the (last) value of `key`."""
+        result = default
+        for name, value in self.settings:
+            if name == key:
+                result = value
+        return result
+
+    def bin_directory(self, name):
+        """Return the index file settings of the `BinDirectory` section `name`."""
+        prefix = "BinDirectory::%s::" % name
+
+        def setting(key, default=None):
+            "Get a section value, or its default."
+            return self.get(prefix + key, self.get("Default::" + key, default))
+
+        return dict(
+            packages=setting("Packages"),
+            sources=setting("SrcPackages"),
+            contents=setting("Contents"),
+            architectures=(setting("Architectures") or "").split(),
+            compress=dict(
+                packages=setting("Packages::Compress", ". gzip").split(),
+                sources=setting("Sources::Compress", ". gzip").split(),
+                contents=setting("Contents::Compress", ". gzip").split(),
+            ),
+        )
+
+
+def read_credentials():
+    """Get repository credentials like "deb-index.sh" does, or None for anonymous access."""
+    result = os.environ.get("ARTIFACTORY_CREDENTIALS")
+    credentials_file = os.path.expanduser("~/.artifactory.credentials")
+    if not result and os.path.exists(credentials_file):
+        with closing(io.open(credentials_file, 'r', encoding='utf-8')) as handle:
+            result = handle.read().strip()
+    return result or None
+
+
+#
+# HTTP access
+#
+
+class DavClient(object):
+    """Authenticated HTTP[S] access to the repository, over a kept-alive connection."""
+
+    def __init__(self, base_url, credentials=None):
+        self.base_url = base_url.rstrip('/') + '/'
+        self.scheme, self.netloc, self.base_path = urlparse.urlparse(self.base_url)[:3]
+        self.auth = credentials and "Basic " + base64.b64encode(credentials.encode('utf-8'))
+        self.conn = None
+        self.requests = 0
+        self.connections = 0
+
+    def url(self, path):
+        """Return the full URL of repository-relative `path`."""
+        return urlparse.urljoin(self.base_url, urllib2.quote(path))
+
+    def request(self, method, path, headers=None, body=None):
+        """ Send a request for the repository-relative or absolute `path`, and return
+            status, headers (a dict with lower-case keys), and body.
+        """
+        url = self.url(path) if "://" not in path else path
+        selector = urlparse.urlunparse(("", "") + urlparse.urlparse(url)[2:])
+        for attempt in (1, 2):
+            reused = self.conn is not None
+            if not reused:
+                self.conn = (httplib.HTTPSConnection if self.scheme == "https" else httplib.HTTPConnection)(self.netloc)
+                self.connections += 1
+            try:
+                self.conn.putrequest(method, selector, skip_accept_encoding=True)
+                self.conn.putheader("User-Agent", "debindex")
+                if self.auth:
+                    self.conn.putheader("Authorization", self.auth)
+                for name, value in (headers or {}).items():
+                    self.conn.putheader(name, value)
+                if body is not None:
+                    self.conn.putheader("Content-Length", str(len(body)))
+                self.conn.endheaders()
+                if body is not None:
+                    self.conn.send(body)
+                resp = self.conn.getresponse()
+                data = resp.read()
+            except (socket.error, httplib.HTTPException), exc:
+                self.close()
+                if reused and attempt == 1:
+                    trace("Kept-alive connection was dropped (%(exc)s), reconnecting...", exc=exc)
+                    continue
+                raise IndexingError("%s %s failed: %s" % (method, url, exc))
+
+            self.requests += 1
+            if resp.will_close:
+                self.close()
+            return resp.status, dict((k.lower(), v) for k, v in resp.getheaders()), data
+
+    def get(self, path, headers=None):
+        """GET `path`, failing for anything but a successful response."""
+        status, resp_headers, data = self.request("GET", path, headers=headers)
+        if not 200 <= status <= 299:
+            raise IndexingError("GET %s failed with HTTP status %d" % (self.url(path), status))
+        return resp_headers, data
+
+    def close(self):
+        """Close the connection."""
+        if self.conn:
+            self.conn.close()
+            self.conn = None
+
+
+def _parse_propfind(body, path):
+    """Parse a "PROPFIND" response for collection `path` into a list of (name, is_dir, props)."""
+    try:
+        multistatus = ElementTree.fromstring(body)
+    except (SyntaxError, expat.ExpatError), exc:
+        raise IndexingError("Malformed PROPFIND response for '%s': %s" % (path, exc))
+
+    result = []
+    basepath = urllib2.unquote(path).rstrip('/')
+    for response in multistatus.findall("{DAV:}response"):
+        href = urllib2.unquote(urlparse.urlparse(response.findtext("{DAV:}href", "").strip())[2]).rstrip('/')
+        if not href or href == basepath:
+            continue
+
+        props = {}
+        for propstat in response.findall("{DAV:}propstat"):
+            if " 200 " in propstat.findtext("{DAV:}status", " 200 "):
+                for prop in propstat.findall("{DAV:}prop/*"):
+                    props[prop.tag.replace("{DAV:}", "")] = prop
+        is_dir = "resourcetype" in props and props["resourcetype"].find("{DAV:}collection") is not None
+        result.append((href.split('/')[-1], is_dir, dict(
+            (key, (val.text or "").strip()) for key, val in props.items() if key != "resourcetype")))
+
+    return result
+
+
+def list_repo(client, repo):
+    """ List all files in `repo`, as a dict of repo-relative paths mapped to
+        their `size`, `mtime`, and `sha1` (as far as the server provides them).
+    """
+    # Artifactory can list a whole tree with checksums in one request
+    base_path = client.base_path.rstrip('/')
+    api_path = "%s/api/storage/%s/%s?list&deep=1&listFolders=0" % (
+        base_path.rsplit('/', 1)[0], base_path.rsplit('/', 1)[-1], urllib2.quote(repo))
+    status, _, data = client.request("GET", urlparse.urljoin(client.base_url, api_path))
+    if status == 200:
+        try:
+            files = json.loads(data)["files"]
+        except (ValueError, KeyError, TypeError), exc:
+            trace("Unexpected storage API response (%(exc)s), using WebDAV", exc=exc)
+        else:
+            return dict((i["uri"].lstrip('/'), dict(size=int(i["size"]), mtime=i.get("lastModified"),
+                sha1=i.get("sha1"), sha256=i.get("sha2"))) for i in files if not i.get("folder"))
+
+    # Walk the tree via WebDAV
+    result = {}
+    pending = [""]
+    while pending:
+        subdir = pending.pop()
+        path = client.base_path + urllib2.quote(repo + '/' + subdir)
+        status, _, data = client.request("PROPFIND", path, headers={"Depth": "1"})
+        if status != 207:
+            raise IndexingError("Listing '%s' failed with HTTP status %d" % (path, status))
+        for name, is_dir, props in _parse_propfind(data, urllib2.unquote(path)):
+            if is_dir:
+                pending.append(subdir + name + '/')
+            else:
+                etag = props.get("getetag", "").replace("W/", "").strip('"').lower()
+                result[subdir + name] = dict(size=int(props.get("getcontentlength") or 0, 10),
+                    mtime=props.get("getlastmodified"), sha1=etag if len(etag) == 40 else None)
+
+    return result
+
+
+#
+# Package metadata
+#
+
+def ar_members(handle):
+    """Iterate over the (name, size, offset) of the members of an `ar` archive."""
+    if handle.read(8) != "!<arch>\n":
+        raise IndexingError("Not an 'ar' archive")
+    offset = 8
+    while True:
+        header = handle.read(60)
+        if len(header) < 60:
+            break
+        name, size = header[:16].strip().rstrip('/'), int(header[48:58].strip(), 10)
+        yield name, size, offset + 60
+        offset += 60 + size + (size % 2)
+        handle.seek(offset)
+
+
+def _decompress(data, name):
+    """Decompress a control or data member of a package, according to its file `name`."""
+    if name.endswith(".gz"):
+        return gzip.GzipFile(fileobj=StringIO(data)).read()
+    elif name.endswith(".bz2"):
+        return bz2.decompress(data)
+    elif name.endswith(".xz") or name.endswith(".lzma") or name.endswith(".zst"):
+        command = ["zstd", "-dcq"] if name.endswith(".zst") else ["xz", "-dcq"]
+        try:
+            import lzma  # Python 3, or the "backports.lzma" shim
+        except ImportError:
+            pass
+        else:
+            if not name.endswith(".zst"):
+                return lzma.decompress(data)
+        proc = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        result = proc.communicate(data)[0]
+        if proc.returncode:
+            raise IndexingError("'%s' failed for %s" % (" ".join(command), name))
+        return result
+    return data
+
+
+def read_control(handle, with_contents=False):
+    """ Read the control data of the `.deb` in `handle`.
+
+        Returns the control file text, and the list of contained files if `with_contents`.
+    """
+    control, contents = None, None
+    for name, size, offset in ar_members(handle):
+        if name.startswith("control.tar"):
+            handle.seek(offset)
+            tar = tarfile.open(fileobj=StringIO(_decompress(handle.read(size), name)))
+            for member in tar.getmembers():
+                if member.name.lstrip('./') == "control":
+                    control = tar.extractfile(member).read()
+            if not with_contents:
+                break
+        elif name.startswith("data.tar") and with_contents:
+            handle.seek(offset)
+            tar = tarfile.open(fileobj=StringIO(_decompress(handle.read(size), name)))
+            contents = sorted(i.name.lstrip('.').lstrip('/') for i in tar.getmembers() if not i.isdir())
+
+    if control is None:
+        raise IndexingError("No control file found in package")
+    return control.decode('utf-8', 'replace'), contents
+
+
+def parse_stanza(text):
+    """Parse a Debian control stanza into a list of (field, value) pairs, keeping continuation lines."""
+    if text.startswith("-----BEGIN PGP SIGNED MESSAGE-----"):
+        text = text.split("-----BEGIN PGP")[1].replace('\r', '').split('\n\n', 1)[1]
+
+    result = []
+    for line in text.splitlines():
+        if not line.strip():
+            if result:
+                break  # only the first paragraph
+        elif line[0] in " \t" and result:
+            result[-1] = (result[-1][0], result[-1][1] + "\n" + line)
+        elif ':' in line:
+            field, value = line.split(':', 1)
+            result.append((field.strip(), value.strip()))
+    return result
+
+
+def format_stanza(fields, order):
+    """Format (field, value) pairs as a stanza, with the fields in `order` first."""
+    rank = dict((field.lower(), i) for i, field in enumerate(order))
+    fields = sorted(enumerate(fields), key=lambda i: (rank.get(i[1][0].lower(), len(order)), i[0]))
+    return "".join("%s: %s\n" % (field, value) if not value.startswith('\n') else "%s:%s\n" % (field, value)
+        for _, (field, value) in fields)
+
+
+def package_stanza(control, filename, size, checksums):
+    """Build the "Packages" stanza of a binary package."""
+    fields = [i for i in parse_stanza(control) if i[0].lower() not in ("filename", "size", "md5sum", "sha1", "sha256")]
+    fields.extend([("Filename", filename), ("Size", str(size)), ("MD5sum", checksums["md5"]),
+        ("SHA1", checksums["sha1"]), ("SHA256", checksums["sha256"])])
+    return format_stanza(fields, PACKAGES_ORDER)
+
+
+def source_stanza(dsc, filename, size, checksums):
+    """Build the "Sources" stanza of a source package, from its `.dsc` file."""
+    dsc_name = os.path.basename(filename)
+    fields = []
+    for field, value in parse_stanza(dsc):
+        if field == "Source":
+            field = "Package"
+        for checksum_field, algo in SOURCE_CHECKSUMS:
+            if field == checksum_field:
+                value = "\n %s %d %s%s" % (checksums[algo], size, dsc_name, value if value.startswith('\n') else "")
+        fields.append((field, value))
+    fields.append(("Directory", os.path.dirname(filename)))
+    return format_stanza(fields, SOURCES_ORDER)
+
+
+def _hash_data(data):
+    """Return the digests of `data`, as needed for indexes."""
+    return dict((algo, getattr(hashlib, algo)(data).hexdigest()) for algo in CHECKSUM_ALGOS)
+
+
+def _field(stanza, name, default=""):
+    """Get a field value from a formatted stanza."""
+    for field, value in parse_stanza(stanza):
+        if field.lower() == name.lower():
+            return value
+    return default
+
+
+#
+# Indexing state
+#
+
+class IndexState(object):
+    """Persistent record of indexed files, with their index stanza and contents."""
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS files (
+            repo TEXT NOT NULL,
+            path TEXT NOT NULL,
+            size INTEGER,
+            mtime TEXT,
+            sha1 TEXT,
+            stanza TEXT,
+            contents TEXT,
+            PRIMARY KEY (repo, path)
+        );
+    """
+
+    # Seconds to wait for another writer, e.g. a "reindex" run next to the service
+    timeout = 60
+
+    # Serializes the writers of this process; their transactions are short,
+    # since all data is collected before anything is stored
+    lock = threading.Lock()
+
+    def __init__(self, filename):
+        self.db = sqlite3.connect(filename, timeout=self.timeout)
+        self.db.executescript(self.SCHEMA)
+
+    def files(self, repo):
+        """Return a dict of indexed files in `repo`, mapped to their `size`, `mtime`, `sha1`, and `stanza`."""
+        return dict((row[0], dict(size=row[1], mtime=row[2], sha1=row[3], stanza=row[4], contents=row[5]))
+            for row in self.db.execute("SELECT path, size, mtime, sha1, stanza, contents FROM files WHERE repo = ?",
+                (repo,)))
+
+    def store(self, repo, vanished, updates):
+        """ Forget the `vanished` files of `repo`, and record the index data of new or changed ones,
+            given as `updates` in the format returned by `files`, in a single transaction.
+        """
+        with self.lock:
+            with self.db:  # commits, or rolls back on errors
+                self.db.executemany("DELETE FROM files WHERE repo = ? AND path = ?", [(repo, i) for i in vanished])
+                self.db.executemany("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?)", [
+                    (repo, path, entry["size"], entry["mtime"], entry["sha1"], entry["stanza"], entry["contents"])
+                    for path, entry in sorted(updates.items())])
+
+    def close(self):
+        """Close the database."""
+        self.db.close()
+
+
+def _unchanged(meta, known):
+    """Check if a listed file still matches its indexed state."""
+    if not known or known["size"] != meta["size"]:
+        return False
+    if meta.get("sha1") and known["sha1"]:
+        return meta["sha1"] == known["sha1"]
+    return meta.get("mtime") == known["mtime"]
+
+
+def _server_checksums(headers):
+    """Get the checksums Artifactory keeps for a file from response `headers`, or None if any are missing."""
+    result = dict((algo, headers.get("x-checksum-" + algo)) for algo in CHECKSUM_ALGOS)
+    return result if all(result.values()) else None
+
+
+def fetch_deb_head(client, filename):
+    """ Fetch the `ar` headers and control member of a `.deb` via Range requests.
+
+        Returns the package size, its server-side checksums (None if not provided),
+        and the start of the package up to the end of the control member.
+        If the server ignores the range, the whole package is returned and hashed locally.
+    """
+    status, headers, data = client.request("GET", filename, headers={"Range": "bytes=0-%d" % (CONTROL_PREFETCH - 1)})
+    if status == 200:
+        return len(data), _hash_data(data), data
+    if status != 206:
+        raise IndexingError("GET %s failed with HTTP status %d" % (client.url(filename), status))
+    try:
+        size = int(headers.get("content-range", "").rsplit('/', 1)[-1], 10)
+    except ValueError:
+        raise IndexingError("Bad Content-Range for %s: %r" % (client.url(filename), headers.get("content-range")))
+
+    for name, member_size, offset in ar_members(StringIO(data)):
+        if name.startswith("control.tar"):
+            if offset + member_size > len(data):
+                trace("Fetching rest of %(name)s in %(filename)s", name=name, filename=filename)
+                status, _, rest = client.request("GET", filename,
+                    headers={"Range": "bytes=%d-%d" % (len(data), offset + member_size - 1)})
+                if status != 206:
+                    raise IndexingError("GET %s failed with HTTP status %d" % (client.url(filename), status))
+                data += rest
+            break
+
+    return size, _server_checksums(headers), data
+
+
+def index_file(client, repo, path, with_contents=False):
+    """Download what is needed of a new or changed file, and return its index stanza and contents."""
+    filename = repo + '/' + path
+    if path.endswith(".deb") and not with_contents:
+        size, checksums, head = fetch_deb_head(client, filename)
+        if checksums is None:
+            trace("No server-side checksums for %(filename)s, downloading it", filename=filename)
+            _, data = client.get(filename)
+            size, checksums = len(data), _hash_data(data)
+        control, _ = read_control(StringIO(head))
+        return package_stanza(control, filename, size, checksums), None
+
+    # Contents indexes need the data member, and sources are small anyway
+    _, data = client.get(filename)
+    checksums = _hash_data(data)
+    if path.endswith(".deb"):
+        control, contents = read_control(StringIO(data), with_contents=with_contents)
+        return package_stanza(control, filename, len(data), checksums), contents
+    else:
+        return source_stanza(data.decode('utf-8', 'replace'), filename, len(data), checksums), None
+
+
+#
+# Index files
+#
+
+def contents_index(entries):
+    """Build a "Contents" index from (stanza, contents) pairs of binary packages."""
+    locations = {}
+    for stanza, contents in entries:
+        section = _field(stanza, "Section", "unknown")
+        location = "%s/%s" % (section, _field(stanza, "Package"))
+        for path in contents or []:
+            locations.setdefault(path, set()).add(location)
+
+    lines = []
+    for path in sorted(locations):
+        column = len(path)
+        line = [path]
+        while column < 60:
+            line.append('\t')
+            column = (column // 8 + 1) * 8
+        lines.append("%s%s\n" % ("".join(line), ",".join(sorted(locations[path]))))
+    return "".join(lines)
+
+
+def write_index(filename, chunks, compress):
+    """ Write the text `chunks` of an index to `filename`, and its compressed variants as listed in `compress`.
+
+        The text is streamed once into all compressors, which run as parallel processes.
+    """
+    outputs, procs = [], []
+    try:
+        for method in compress:
+            if method == '.':
+                outputs.append(io.open(filename, 'wb'))
+                continue
+            if method not in COMPRESSORS:
+                raise IndexingError("Unsupported compression method '%s'" % method)
+            ext, command = COMPRESSORS[method]
+            with closing(io.open(filename + ext, 'wb')) as handle:
+                try:
+                    procs.append((command, subprocess.Popen(command, stdin=subprocess.PIPE, stdout=handle)))
+                except OSError, exc:
+                    raise IndexingError("Cannot start '%s': %s" % (command[0], exc))
+            outputs.append(procs[-1][1].stdin)
+
+        for chunk in chunks:
+            data = chunk.encode('utf-8')
+            for output in outputs:
+                output.write(data)
+    finally:
+        for output in outputs:
+            try:
+                output.close()
+            except EnvironmentError:
+                pass  # the compressor failed, reported below
+        for command, proc in procs:
+            if proc.wait():
+                raise IndexingError("'%s' failed with exit code %d for %s" % (" ".join(command), proc.returncode, filename))
+
+
+def release_file(repo, workdir, now=None):
+    """Build the "Release" file of a repository, listing the index files in `workdir`."""
+    fields = dict(repo["release"])
+    fields["Date"] = time.strftime("%a, %d %b %Y %H:%M:%S UTC", time.gmtime(now))
+    lines = ["%s: %s\n" % (field, fields[field]) for field in RELEASE_FIELDS if fields.get(field)]
+
+    files = sorted(name for name in os.listdir(workdir)
+        if os.path.isfile(os.path.join(workdir, name)) and not os.path.islink(os.path.join(workdir, name))
+        and any(fnmatch.fnmatchcase(name, i) for i in RELEASE_PATTERNS))
+    checksums = {}
+    for name in files:
+        with closing(io.open(os.path.join(workdir, name), 'rb')) as handle:
+            data = handle.read()
+        checksums[name] = len(data), _hash_data(data)
+    for field, algo in RELEASE_CHECKSUMS:
+        lines.append("%s:\n" % field)
+        lines.extend(" %s %16d %s\n" % (checksums[name][1][algo], checksums[name][0], name) for name in files)
+
+    return "".join(lines)
+
+
+def update_repo(repo, client, state, workdir):
+    """ Update the state of `repo`, and write its index files below `workdir`.
+
+        Returns False if nothing changed since the index files were last written,
+        which are then kept as they are.
+    """
+    name = repo["name"]
+    listing = list_repo(client, name)
+    known = state.files(name)
+    with_contents = bool(repo["contents"])
+
+    vanished = [i for i in known if i not in listing]
+    changed = [i for i in sorted(listing) if i.endswith((".deb", ".dsc")) and not (
+        _unchanged(listing[i], known.get(i)) and (
+            known[i]["contents"] is not None or not with_contents or not i.endswith(".deb")))]
+    log("INFO: %(repo)s: %(total)d files listed, %(changed)d new or changed, %(vanished)d vanished",
+        repo=name, total=len(listing), changed=len(changed), vanished=len(vanished))
+
+    repodir = os.path.join(workdir, name)
+    if not changed and not vanished and _newer(os.path.join(repodir, "Release"), [
+            os.path.join(repo["confdir"], "apt-ftparchive.conf"), os.path.join(repo["confdir"], "repo-%s.conf" % name)]):
+        trace("Keeping index files of %(repo)s", repo=name)
+        return False
+
+    # Nothing is stored before the index files are written, so failures are repeated by the next run,
+    # and the database isn't locked while fetching packages
+    updates = {}
+    for path in changed:
+        trace("Indexing %(repo)s/%(path)s", repo=name, path=path)
+        stanza, contents = index_file(client, name, path, with_contents=with_contents)
+        updates[path] = dict(size=listing[path]["size"], mtime=listing[path].get("mtime"),
+            sha1=listing[path].get("sha1"), stanza=stanza, contents=None if contents is None else "\n".join(contents))
+
+    files = dict((path, entry) for path, entry in known.items() if path not in vanished)
+    files.update(updates)
+    write_repo_indexes(repo, files, repodir)
+    state.store(name, vanished, updates)
+    return True
+
+
+def reindex(config, base_url, credentials, state_file, workdir, jobs=1, names=None):
+    """ Update the state of all repos (or those in `names`), and write their index files below `workdir`.
+
+        Up to `jobs` repos are processed in parallel, each with its own connection and database handle.
+        Returns the names of the repos whose index files were written.
+    """
+    repos = [i for i in config.repos if names is None or i["name"] in names]
+    clients, written = [], []
+
+    def update_one(repo):
+        "Update a single repo."
+        client, state = DavClient(base_url, credentials), IndexState(state_file)
+        clients.append(client)
+        try:
+            if update_repo(repo, client, state, workdir):
+                written.append(repo["name"])
+        finally:
+            state.close()
+            client.close()
+
+    _run_parallel(update_one, repos, jobs)
+    trace("Sent %(requests)d request(s) over %(connections)d connection(s)",
+        requests=sum(i.requests for i in clients), connections=sum(i.connections for i in clients))
+    return written
+
+
+def _newer(filename, others):
+    """Check that `filename` exists, and was modified after all `others`."""
+    try:
+        mtime = os.path.getmtime(filename)
+    except EnvironmentError:
+        return False
+    return all(mtime > os.path.getmtime(i) for i in others if os.path.exists(i))
+
+
+def _run_parallel(func, items, workers):
+    """ Call `func` for each of `items`, using up to `workers` threads.
+
+        After the first failure no further calls are started, and that error
+        is re-raised after all running calls have finished.
+    """
+    if workers <= 1 or len(items) <= 1:
+        for item in items:
+            func(item)
+        return
+
+    lock = threading.Lock()
+    pending = iter(items)
+    errors = []
+
+    def worker():
+        "Process items until all are done, or something failed."
+        while not errors:
+            with lock:
+                try:
+                    item = pending.next()
+                except StopIteration:
+                    break
+            try:
+                func(item)
+            except: # pylint: disable=bare-except
+                errors.append(sys.exc_info())
+
+    threads = [threading.Thread(target=worker) for _ in range(min(workers, len(items)))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        while thread.isAlive():
+            thread.join(0.25)  # stay responsive to Ctrl-C
+
+    if errors:
+        raise errors[0][0], errors[0][1], errors[0][2]
+
+
+def _stanzas(files):
+    """Generate the stanzas of indexed `files`, each followed by an empty line (like apt-ftparchive)."""
+    for entry in files:
+        yield entry["stanza"] + "\n"
+
+
+def write_repo_indexes(repo, files, repodir):
+    """Write "Packages", "Sources", "Contents", and "Release" of a repo from its indexed `files`."""
+    if not os.path.isdir(repodir):
+        os.makedirs(repodir)
+    base = os.path.dirname(repodir)
+
+    binaries = [files[i] for i in sorted(files) if i.endswith(".deb")]
+    sources = [files[i] for i in sorted(files) if i.endswith(".dsc")]
+    if repo["packages"]:
+        write_index(os.path.join(base, repo["packages"]), _stanzas(binaries), repo["compress"]["packages"])
+    if repo["sources"]:
+        write_index(os.path.join(base, repo["sources"]), _stanzas(sources), repo["compress"]["sources"])
+    if repo["contents"]:
+        write_index(os.path.join(base, repo["contents"]),
+            [contents_index((i["stanza"], (i["contents"] or "").splitlines()) for i in binaries)],
+            repo["compress"]["contents"])
+
+    release = release_file(repo, repodir)
+    with closing(io.open(os.path.join(repodir, "Release"), 'wb')) as handle:
+        handle.write(release.encode('utf-8'))
+
+    log("INFO: %(repo)s: %(packages)s", repo=repo["name"],
+        packages=" ".join(sorted(set(_field(i["stanza"], "Package") for i in binaries))))
+
+
+#
+# Publishing
+#
+
+def publish_order(names):
+    """ Sort index file `names` in the order they must be published.
+
+        Packages and Sources come first, "Release" and its signatures last,
+        so that clients never see a "Release" that refers to missing indexes.
+    """
+    return sorted(names, key=lambda name: (
+        RELEASE_NAMES.index(name) + 1 if name in RELEASE_NAMES else 0,
+        not name.startswith(("Packages", "Sources")), name))
+
+
+def publish_repo(client, name, repodir):
+    """ Upload the index files of repo `name` in `repodir`, skipping those that are unchanged on the server.
+
+        Files not written since the last publishing (recorded in ".published") are skipped right away.
+    """
+    stamp = os.path.join(repodir, ".published")
+    files = [i for i in os.listdir(repodir)
+        if os.path.isfile(os.path.join(repodir, i)) and not os.path.islink(os.path.join(repodir, i))
+        and not i.startswith('.')]
+    files = [i for i in files if not _newer(stamp, [os.path.join(repodir, i)])]
+    if not files:
+        trace("Nothing new to publish in %(repodir)s", repodir=repodir)
+        return
+
+    for filename in publish_order(files):
+        with closing(io.open(os.path.join(repodir, filename), 'rb')) as handle:
+            data = handle.read()
+        if not data and ('.' in filename or filename in RELEASE_NAMES):  # plain indexes of empty repos are OK
+            raise IndexingError("'%s' is empty" % os.path.join(repodir, filename))
+        checksums = _hash_data(data)
+
+        path = name + '/' + filename
+        status, headers, _ = client.request("HEAD", path)
+        if status == 200 and headers.get("x-checksum-sha256") == checksums["sha256"]:
+            trace("Unchanged: %(path)s", path=path)
+            continue
+
+        log("INFO: PUTting %(url)s", url=client.url(path))
+        status, _, body = client.request("PUT", path, body=data, headers=dict(
+            ("X-Checksum-" + algo.capitalize(), val) for algo, val in checksums.items()))
+        if not 200 <= status <= 299:
+            raise IndexingError("PUT %s failed with HTTP status %d: %s" % (client.url(path), status, body[:200]))
+
+    with closing(io.open(stamp, 'wb')):
+        pass
+
+
+def publish(config, base_url, credentials, workdir, jobs=1, names=None):
+    """Upload the index files of all repos (or those in `names`), using up to `jobs` connections."""
+    if not credentials:
+        raise IndexingError("Artifactory deployment credentials are missing")
+    repos = [i["name"] for i in config.repos
+        if (names is None or i["name"] in names) and os.path.isdir(os.path.join(workdir, i["name"]))]
+    clients = []
+
+    def publish_one(name):
+        "Publish a single repo, over its own connection."
+        client = DavClient(base_url, credentials)
+        clients.append(client)
+        try:
+            publish_repo(client, name, os.path.join(workdir, name))
+        finally:
+            client.close()
+
+    _run_parallel(publish_one, repos, jobs)
+    trace("Sent %(requests)d request(s) over %(connections)d connection(s)",
+        requests=sum(i.requests for i in clients), connections=sum(i.connections for i in clients))
+
+
+#
+# Indexing service
+#
+
+class RefreshScheduler(object):
+    """ Debounced refreshes of repositories, triggered by upload notifications.
+
+        A repo is refreshed once no notification for it arrived for `debounce` seconds,
+        but no later than `max_delay` seconds after the first one. Only one refresh
+        per repo runs at a time; notifications during a run trigger another one.
+    """
+
+    def __init__(self, names, debounce=10.0, max_delay=60.0):
+        self.names = list(names)
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self.cond = threading.Condition()
+        self.pending = {}  # repo -> (first, last) notification time
+        self.running = {}  # repo -> (started, first notification time)
+        self.stats = dict((i, dict(ok=0, failed=0, duration=None, finished=None)) for i in self.names)
+        self.notifications = 0
+
+    def notify(self, name=None, now=None):
+        """Record an upload to repo `name`, or to all repos; returns the names of the affected repos."""
+        names = self.names if name is None else [name]
+        if name is not None and name not in self.names:
+            raise KeyError(name)
+        now = now or time.time()
+        with self.cond:
+            self.notifications += 1
+            for repo in names:
+                first = self.pending.get(repo, (now, now))[0]
+                self.pending[repo] = (first, now)
+            self.cond.notify()
+        return names
+
+    def due(self, now=None):
+        """ Start all pending refreshes that are due, and return their repo names,
+            plus the number of seconds until the next one is due (or None).
+        """
+        now = now or time.time()
+        started, wait = [], None
+        with self.cond:
+            for repo, (first, last) in sorted(self.pending.items()):
+                if repo in self.running:
+                    continue
+                at = min(last + self.debounce, first + self.max_delay)
+                if at <= now:
+                    del self.pending[repo]
+                    self.running[repo] = (now, first)
+                    started.append(repo)
+                else:
+                    wait = at - now if wait is None else min(wait, at - now)
+        return started, wait
+
+    def finished(self, name, success, now=None):
+        """Record the end of the refresh of repo `name`."""
+        now = now or time.time()
+        with self.cond:
+            started, _ = self.running.pop(name)
+            stats = self.stats[name]
+            stats["ok" if success else "failed"] += 1
+            stats["duration"] = now - started
+            if success:
+                stats["finished"] = now
+            self.cond.notify()
+
+    def metrics(self, now=None):
+        """Return the current state in the Prometheus text format."""
+        now = now or time.time()
+        with self.cond:
+            lines = [
+                "# TYPE debindex_notifications_total counter",
+                "debindex_notifications_total %d" % self.notifications,
+                "# TYPE debindex_queue_depth gauge",
+                "debindex_queue_depth %d" % len(self.pending),
+                "# TYPE debindex_running gauge",
+                "debindex_running %d" % len(self.running),
+                "# HELP debindex_freshness_lag_seconds Age of the oldest upload not yet in the published index",
+                "# TYPE debindex_freshness_lag_seconds gauge",
+            ]
+            for repo in self.names:
+                notified = [self.running[repo][1]] if repo in self.running else []
+                notified += [self.pending[repo][0]] if repo in self.pending else []
+                lines.append('debindex_freshness_lag_seconds{repo="%s"} %.3f' % (repo, now - min(notified or [now])))
+            lines.append("# TYPE debindex_refreshes_total counter")
+            for repo in self.names:
+                for result in ("ok", "failed"):
+                    lines.append('debindex_refreshes_total{repo="%s",result="%s"} %d'
+                        % (repo, result, self.stats[repo][result]))
+            lines.append("# TYPE debindex_refresh_duration_seconds gauge")
+            lines.extend('debindex_refresh_duration_seconds{repo="%s"} %.3f' % (repo, self.stats[repo]["duration"])
+                for repo in self.names if self.stats[repo]["duration"] is not None)
+            lines.append("# TYPE debindex_last_success_timestamp_seconds gauge")
+            lines.extend('debindex_last_success_timestamp_seconds{repo="%s"} %.3f' % (repo, self.stats[repo]["finished"])
+                for repo in self.names if self.stats[repo]["finished"] is not None)
+        return "\n".join(lines) + "\n"
+
+    def run(self, refresh, stopped):
+        """Call `refresh` with each repo name that is due, in a thread of its own, until `stopped` is set."""
+        def refresh_one(name):
+            "Refresh a single repo, and record the result."
+            success = False
+            try:
+                refresh(name)
+                success = True
+            except Exception, exc: # pylint: disable=broad-except
+                log("ERROR: Refreshing %(repo)s failed: %(exc)s", repo=name, exc=exc)
+            finally:
+                self.finished(name, success)
+
+        while not stopped.isSet():
+            started, wait = self.due()
+            for name in started:
+                thread = threading.Thread(target=refresh_one, args=(name,), name="refresh-" + name)
+                thread.daemon = True
+                thread.start()
+            with self.cond:
+                if not stopped.isSet():
+                    self.cond.wait(min(wait, 1.0) if wait else 1.0)
+
+
+class NotifyHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """ Upload notifications (``POST /notify[/«repo»]``) and metrics (``GET /metrics``).
+
+        Without a repo name, all repos are refreshed.
+    """
+
+    server_version = "debindex"
+
+    def do_POST(self): # pylint: disable=invalid-name
+        """Queue a refresh."""
+        self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        path = urlparse.urlparse(self.path)[2].rstrip('/')
+        if path != "/notify" and not path.startswith("/notify/"):
+            return self.reply(404, "Not found\n")
+        name = urllib.unquote(path[len("/notify/"):]) or None
+        try:
+            names = self.server.scheduler.notify(name)
+        except KeyError:
+            return self.reply(404, "Unknown repository '%s'\n" % name)
+        trace("Refresh of %(repos)s requested by %(client)s", repos=", ".join(names), client=self.client_address[0])
+        return self.reply(202, "Queued %s\n" % " ".join(names))
+
+    def do_GET(self): # pylint: disable=invalid-name
+        """Report metrics."""
+        if urlparse.urlparse(self.path)[2] != "/metrics":
+            return self.reply(404, "Not found\n")
+        return self.reply(200, self.server.scheduler.metrics(), "text/plain; version=0.0.4")
+
+    def reply(self, status, body, content_type="text/plain"):
+        """Send a complete response."""
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args): # pylint: disable=redefined-builtin
+        """Only log requests in debug mode."""
+        trace("%(client)s %(request)s", client=self.client_address[0], request=format % args)
+
+
+def serve(config, base_url, credentials, workdir, state_file, address, debounce=10.0, max_delay=60.0):
+    """Refresh (reindex and publish) repos on notifications sent to `address`, until interrupted."""
+    scheduler = RefreshScheduler([i["name"] for i in config.repos], debounce, max_delay)
+
+    def refresh(name):
+        "Reindex and publish a single repo."
+        started = time.time()
+        reindex(config, base_url, credentials, state_file, workdir, names=[name])
+        # Always publish, to complete an earlier failed publish; unchanged files are skipped
+        publish(config, base_url, credentials, workdir, names=[name])
+        log("INFO: %(repo)s: refreshed in %(secs).1f secs", repo=name, secs=time.time() - started)
+
+    host, port = (address.rsplit(':', 1) if ':' in address else ("127.0.0.1", address))
+    server = BaseHTTPServer.HTTPServer((host, int(port, 10)), NotifyHandler)
+    server.scheduler = scheduler
+    stopped = threading.Event()
+    worker = threading.Thread(target=scheduler.run, args=(refresh, stopped), name="scheduler")
+    worker.daemon = True
+    worker.start()
+
+    log("INFO: Listening for notifications on http://%(host)s:%(port)d/notify/<repo>",
+        host=server.server_address[0], port=server.server_address[1])
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        log("INFO: Stopping")
+    finally:
+        stopped.set()
+        server.server_close()
+
+
+def _makedirs_for(filename):
+    """Create the parent directory of `filename`, if missing."""
+    if not os.path.isdir(os.path.dirname(os.path.abspath(filename))):
+        os.makedirs(os.path.dirname(os.path.abspath(filename)))
+
+
+def main(argv=None):
+    """Command line interface."""
+    parser = optparse.OptionParser(usage="%prog reindex|publish|serve [options] <repository URL>")
+    parser.add_option("-c", "--confdir", default=".", help="directory with the apt-ftparchive configuration")
+    parser.add_option("-w", "--workdir", default="work", help="directory for the generated index files")
+    parser.add_option("-s", "--state", default="tmp/debindex.db", help="path of the indexing state database")
+    parser.add_option("-j", "--jobs", type="int", default=cpu_count(),
+        help="number of repositories to index or upload in parallel [%default]")
+    parser.add_option("-l", "--listen", default="127.0.0.1:8090",
+        help="[host:]port to receive notifications on, for 'serve' [%default]")
+    parser.add_option("--debounce", type="float", default=10.0,
+        help="seconds without further notifications before a repo is refreshed [%default]")
+    parser.add_option("--max-delay", type="float", default=60.0,
+        help="seconds after a notification a repo is refreshed at the latest [%default]")
+    parser.add_option("-d", "--debug", action="store_true", default=False, help="show debug traces")
+    opts, args = parser.parse_args(argv)
+    if len(args) != 2 or args[0] not in ("reindex", "publish", "serve"):
+        parser.error("Expected 'reindex', 'publish', or 'serve', and a repository URL")
+    trace.debug = opts.debug
+
+    try:
+        config = ArchiveConfig(opts.confdir)
+        if args[0] == "publish":
+            publish(config, args[1], read_credentials(), opts.workdir, jobs=opts.jobs)
+            return 0
+        elif args[0] == "serve":
+            _makedirs_for(opts.state)
+            serve(config, args[1], read_credentials(), opts.workdir, opts.state, opts.listen,
+                debounce=opts.debounce, max_delay=opts.max_delay)
+            return 0
+
+        _makedirs_for(opts.state)
+        reindex(config, args[1], read_credentials(), opts.state, opts.workdir, jobs=opts.jobs)
+    except (IndexingError, EnvironmentError, sqlite3.Error), exc:
+        log("FATAL: %(exc)s", exc=exc)
+        return 1
+
+    return 0
+
+
+#
+# Unit Tests
+#
+
+class DebIndexTest(unittest.TestCase): # pylint: disable=too-many-public-methods
+    """Local unittests."""
+
+    def test_parse_apt_conf(self):
+        """Test apt configuration parsing."""
+        result = parse_apt_conf('''
+            Dir {
+                ArchiveDir ".";   // comment
+            };
+            # comment
+            BinDirectory "noplat" {
+                Packages "noplat/Packages";
+                Architectures "all sources";
+            };
+            Default { Packages::Compress ". gzip bzip2"; }
+        ''')
+        self.assertEquals(result, [
+            ("Dir::ArchiveDir", "."),
+            ("BinDirectory::noplat::Packages", "noplat/Packages"),
+            ("BinDirectory::noplat::Architectures", "all sources"),
+            ("Default::Packages::Compress", ". gzip bzip2"),
+        ])
+        self.assertRaises(IndexingError, parse_apt_conf, "Dir { ArchiveDir \".\";")
+
+    def test_archive_config(self):
+        """Test reading the sample configuration."""
+        config = ArchiveConfig(os.path.dirname(os.path.abspath(__file__)))
+        self.assertEquals([i["name"] for i in config.repos], ["noplat"])
+        repo = config.repos[0]
+        self.assertEquals(repo["packages"], "noplat/Packages")
+        self.assertEquals(repo["compress"]["packages"], [".", "gzip", "bzip2"])
+        self.assertEquals(repo["compress"]["contents"], ["gzip", "bzip2"])
+        self.assertEquals(repo["release"]["Suite"], "noplat")
+
+    def test_package_stanza(self):
+        """Test building a "Packages" entry."""
+        control = "Package: foo\nVersion: 1.0\nArchitecture: all\nMaintainer: Me <me@example.com>\n" \
+            "Description: Foo\n Long text.\n .\n More.\nSection: devel\nInstalled-Size: 12\n"
+        result = package_stanza(control, "noplat/foo/1.0/foo_1.0_all.deb", 42, _hash_data(""))
+        self.assertEquals(result.splitlines()[:4], ["Package: foo", "Section: devel", "Installed-Size: 12",
+            "Maintainer: Me <me@example.com>"])
+        self.assertTrue("\nFilename: noplat/foo/1.0/foo_1.0_all.deb\nSize: 42\nMD5sum: d41d8cd98f00b204e9800998ecf8427e\n"
+            in result)
+        self.assertTrue(result.endswith("Description: Foo\n Long text.\n .\n More.\n"))
+
+    def test_source_stanza(self):
+        """Test building a "Sources" entry."""
+        dsc = "Format: 1.0\nSource: foo\nVersion: 1.0\nFiles:\n 0123 10 foo_1.0.tar.gz\n"
+        result = source_stanza(dsc, "noplat/foo/1.0/foo_1.0.dsc", 42, _hash_data(""))
+        self.assertEquals(result, "Package: foo\nVersion: 1.0\nFormat: 1.0\nDirectory: noplat/foo/1.0\n"
+            "Files:\n d41d8cd98f00b204e9800998ecf8427e 42 foo_1.0.dsc\n 0123 10 foo_1.0.tar.gz\n")
+
+    def test_contents_index(self):
+        """Test "Contents" formatting."""
+        result = contents_index([
+            ("Package: foo\nSection: devel\n", ["usr/bin/foo", "usr/share/doc/foo/copyright"]),
+            ("Package: bar\nSection: utils\n", ["usr/bin/foo"]),
+        ])
+        self.assertEquals(result, "usr/bin/foo\t\t\t\t\t\t\tdevel/foo,utils/bar\n"
+            "usr/share/doc/foo/copyright\t\t\t\t\tdevel/foo\n")
+
+    def test_fetch_deb_head(self):
+        """Test reading control data via Range requests."""
+        control = "Package: foo\nVersion: 1.0\nArchitecture: all\nDescription: Foo\n"
+        control_tar = StringIO()
+        with closing(tarfile.open(fileobj=control_tar, mode="w:gz")) as tar:
+            info = tarfile.TarInfo("./control")
+            info.size = len(control)
+            tar.addfile(info, StringIO(control))
+        members = [("debian-binary", "2.0\n"), ("control.tar.gz", control_tar.getvalue()),
+            ("data.tar.gz", os.urandom(3 * CONTROL_PREFETCH))]
+        deb = "!<arch>\n" + "".join("%-16s%-12d%-6d%-6d%-8s%-10d`\n%s%s" % (name + '/', 0, 0, 0, "100644",
+            len(data), data, "\n" if len(data) % 2 else "") for name, data in members)
+        checksums = _hash_data(deb)
+
+        class Client(object):
+            "Serve `deb` with Artifactory's headers."
+            def __init__(self, ranges=True):
+                self.ranges, self.fetched = ranges, 0
+            def url(self, path):
+                return path
+            def request(self, _, dummy, headers=None):
+                "Serve a range."
+                start, end = [int(i) for i in headers["Range"].split('=')[1].split('-')]
+                if not self.ranges:
+                    return 200, {}, deb
+                resp_headers = dict(("x-checksum-" + key, val) for key, val in checksums.items())
+                resp_headers["content-range"] = "bytes %d-%d/%d" % (start, end, len(deb))
+                self.fetched += end + 1 - start
+                return 206, resp_headers, deb[start:end + 1]
+
+        client = Client()
+        size, result, head = fetch_deb_head(client, "foo.deb")
+        self.assertEquals((size, result), (len(deb), checksums))
+        self.assertEquals(parse_stanza(read_control(StringIO(head))[0])[0], ("Package", "foo"))
+        self.assertEquals(client.fetched, CONTROL_PREFETCH)
+
+        client = Client(ranges=False)
+        self.assertEquals(fetch_deb_head(client, "foo.deb"), (len(deb), checksums, deb))
+
+    def test_write_index(self):
+        """Test that compressed indexes match the output of plain 'gzip' and 'bzip2' (as used before)."""
+        import shutil, tempfile
+        tmpdir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tmpdir, "Packages")
+            chunks = ["Package: foo%d\nVersion: 1.0\n\n" % i for i in range(1000)]
+            write_index(filename, chunks, [".", "gzip", "bzip2"])
+            with closing(io.open(filename, 'rb')) as handle:
+                data = handle.read()
+            self.assertEquals(data, "".join(chunks))
+            for ext, command in ((".gz", ["gzip"]), (".bz2", ["bzip2"])):
+                with closing(io.open(filename + ext, 'rb')) as handle:
+                    proc = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+                    self.assertEquals(handle.read(), proc.communicate(data)[0])
+            self.assertRaises(IndexingError, write_index, filename, chunks, ["lha"])
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_publish_order(self):
+        """Test that "Release" is published last."""
+        self.assertEquals(publish_order(["InRelease", "Release", "Contents.gz", "Sources", "Release.gpg",
+            "Packages.gz", "Packages"]), ["Packages", "Packages.gz", "Sources", "Contents.gz",
+            "Release", "Release.gpg", "InRelease"])
+
+    def test_unchanged(self):
+        """Test change detection."""
+        known = dict(size=10, mtime="then", sha1="abc")
+        self.assertTrue(_unchanged(dict(size=10, mtime="now", sha1="abc"), known))
+        self.assertFalse(_unchanged(dict(size=10, mtime="then", sha1="def"), known))
+        self.assertFalse(_unchanged(dict(size=11, mtime="then", sha1="abc"), known))
+        self.assertTrue(_unchanged(dict(size=10, mtime="then"), known))
+        self.assertFalse(_unchanged(dict(size=10, mtime="now"), known))
+        self.assertFalse(_unchanged(dict(size=10), None))
+
+    def test_refresh_scheduler(self):
+        """Test debouncing notifications, and one refresh per repo at a time."""
+        scheduler = RefreshScheduler(["a", "b"], debounce=10, max_delay=30)
+        self.assertRaises(KeyError, scheduler.notify, "c")
+        for now in (100, 105, 112):
+            scheduler.notify("a", now=now)
+        self.assertEquals(scheduler.notify(now=112), ["a", "b"])
+        self.assertEquals(scheduler.due(now=121), ([], 1))
+        self.assertEquals(scheduler.due(now=122), (["a", "b"], None))
+
+        scheduler.notify("a", now=123)
+        self.assertEquals(scheduler.due(now=200), ([], None))  # "a" is still running
+        self.assertTrue('debindex_freshness_lag_seconds{repo="a"} 100.000' in scheduler.metrics(now=200))
+        self.assertTrue("debindex_queue_depth 1" in scheduler.metrics(now=200))
+        scheduler.finished("a", True, now=200)
+        scheduler.finished("b", False, now=200)
+        self.assertEquals(scheduler.due(now=200), (["a"], None))
+
+        # Continuous notifications don't delay a refresh beyond `max_delay`
+        for now in range(300, 340, 5):
+            scheduler.notify("b", now=now)
+            self.assertEquals(scheduler.due(now=now)[0], ["b"] if now == 330 else [])
+        metrics = scheduler.metrics(now=340)
+        self.assertTrue('debindex_refreshes_total{repo="b",result="failed"} 1' in metrics)
+        self.assertTrue('debindex_last_success_timestamp_seconds{repo="a"} 200.000' in metrics)
+
+    def _serve_repos(self, names, delay):
+        """ Start a server for repos `names` with a few source packages each, served after `delay` seconds.
+
+            Returns the server, and the configuration of the repos (in a temporary `confdir`).
+        """
+        import tempfile
+        import SocketServer
+
+        files = dict(("/art/debian-local/%s/foo/foo_1.%d.dsc" % (name, i),
+            "Format: 1.0\nSource: foo\nVersion: 1.%d\nBinary: foo\nFiles:\n 0123 10 foo_1.%d.tar.gz\n" % (i, i))
+            for name in names for i in range(3))
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            "Serve the storage API listing, and the files."
+            protocol_version = "HTTP/1.1"
+            def log_message(self, *args): # pylint: disable=arguments-differ
+                pass
+            def do_GET(self): # pylint: disable=invalid-name
+                "Serve a listing or file."
+                path = self.path.split('?')[0]
+                if path.startswith("/art/api/storage/"):
+                    base = path.replace("/api/storage/", "/") + '/'
+                    body = json.dumps(dict(files=[dict(uri=i[len(base) - 1:], size=len(data), sha1=None)
+                        for i, data in files.items() if i.startswith(base)]))
+                else:
+                    time.sleep(delay)
+                    body = files[path]
+                self.send_response(200)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+            "Threaded test server."
+            daemon_threads = True
+
+        server = Server(("127.0.0.1", 0), Handler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+        confdir = tempfile.mkdtemp()
+        with closing(io.open(os.path.join(confdir, "apt-ftparchive.conf"), 'w', encoding='utf-8')) as handle:
+            handle.write(u"Default { Sources::Compress \".\"; };\n")
+            for name in names:
+                handle.write(u'BinDirectory "%s" { SrcPackages "%s/Sources"; };\n' % (name, name))
+        for name in names:
+            io.open(os.path.join(confdir, "repo-%s.conf" % name), 'w', encoding='utf-8').close()
+        return server, ArchiveConfig(confdir)
+
+    def test_parallel_reindex(self):
+        """Test that repos indexed in parallel don't lock each other out of the state database."""
+        import shutil, tempfile
+
+        server, config = self._serve_repos(["a", "b"], delay=0.2)
+        workdir = tempfile.mkdtemp()
+        base_url = "http://127.0.0.1:%d/art/debian-local/" % server.server_address[1]
+        timeout, IndexState.timeout = IndexState.timeout, 0.3  # way shorter than fetching a repo
+        try:
+            written = reindex(config, base_url, None, os.path.join(workdir, "state.db"), workdir, jobs=2)
+            self.assertEquals(sorted(written), ["a", "b"])
+            for name in ("a", "b"):
+                with closing(io.open(os.path.join(workdir, name, "Sources"), 'r', encoding='utf-8')) as handle:
+                    self.assertEquals(handle.read().count("Package: foo\n"), 3)
+        finally:
+            IndexState.timeout = timeout
+            server.shutdown()
+            shutil.rmtree(workdir)
+            shutil.rmtree(config.confdir)
+
+    def test_concurrent_refreshes(self):
+        """Test the service refreshing two repos at the same time."""
+        import shutil, tempfile
+
+        server, config = self._serve_repos(["a", "b"], delay=0.2)
+        workdir = tempfile.mkdtemp()
+        base_url = "http://127.0.0.1:%d/art/debian-local/" % server.server_address[1]
+        timeout, IndexState.timeout = IndexState.timeout, 0.3  # way shorter than fetching a repo
+        scheduler = RefreshScheduler(["a", "b"], debounce=0, max_delay=0)
+        stopped, runs = threading.Event(), {}
+
+        def refresh(name):
+            "Reindex a single repo, like the service does."
+            started = time.time()
+            reindex(config, base_url, None, os.path.join(workdir, "state.db"), workdir, names=[name])
+            runs[name] = (started, time.time())
+
+        worker = threading.Thread(target=scheduler.run, args=(refresh, stopped))
+        worker.daemon = True
+        try:
+            scheduler.notify()
+            worker.start()
+            deadline = time.time() + 30
+            while len(scheduler.running) + len(scheduler.pending) and time.time() < deadline:
+                time.sleep(0.05)
+            self.assertEquals([scheduler.stats[i]["ok"] for i in ("a", "b")], [1, 1])
+            self.assertTrue(max(i[0] for i in runs.values()) < min(i[1] for i in runs.values()))  # overlapping
+        finally:
+            stopped.set()
+            IndexState.timeout = timeout
+            server.shutdown()
+            shutil.rmtree(workdir)
+            shutil.rmtree(config.confdir)
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["test"]:
+        del sys.argv[1]
+        unittest.main()
+    else:
+        sys.exit(main())